@@ -0,0 +1,130 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+'''
+Compute how the on-call burden is shared, with NumPy.
+
+Shifts are split at the local midnights of the roster time zone, and each
+piece is attributed to the local day it falls in.  Hours are then summed per
+person and per quarter, in total and for the pieces falling on weekends, at
+night or on holidays.  All of this is done with array operations, so that
+years of shifts take a fraction of a second: the only Python loops are the
+ones over the shifts and the days (to convert them to timestamps).  Local
+midnights come from the table in `utils.day_starts`, where DST is accounted
+for once per month and time zone.
+'''
+from datetime import datetime, timedelta
+from collections import namedtuple
+
+import pytz
+
+from utils import timestamp, day_starts
+from intervals import AVAILABLE
+
+if AVAILABLE:
+    import numpy
+
+Row = namedtuple('Row', 'quarter name hours weekend night holiday')
+
+
+def local_days(start, end, time_zone, night):
+    '''Return the local days between `start` and `end`, as arrays.
+
+    Returns a tuple with the dates of the days, the timestamps of their
+    midnights (plus the one ending the last day), and the timestamps at which
+    the night starts and ends on each of them.
+
+    Arguments:
+        night: the (start, end) hours of the night, e.g.: (22, 7).
+    '''
+    tz = pytz.timezone(time_zone)
+    first = start.astimezone(tz).date()
+    last = end.astimezone(tz).date()
+    dates = [first + timedelta(days=count)
+             for count in range((last - first).days + 1)]
+    midnights = numpy.array([timestamp(midnight) for midnight
+                             in day_starts(time_zone, first, last)])
+    night_starts = midnights[:-1] + night[0] * 3600
+    night_ends = midnights[:-1] + night[1] * 3600
+    # Only on the days of a DST change the wall hours are not at a fixed
+    # distance from midnight
+    for index in numpy.flatnonzero(numpy.diff(midnights) != 86400):
+        wall = datetime(dates[index].year, dates[index].month,
+                        dates[index].day)
+        night_starts[index] = timestamp(
+            tz.localize(wall.replace(hour=night[0])))
+        night_ends[index] = timestamp(
+            tz.localize(wall.replace(hour=night[1])))
+    return dates, midnights, night_starts, night_ends
+
+
+def overlap(start, end, other_start, other_end):
+    '''Return the (element-wise) length of the overlap of two ranges.'''
+    return numpy.clip(numpy.minimum(end, other_end) -
+                      numpy.maximum(start, other_start), 0, None)
+
+
+def analyse(shifts, time_zone, night=(22, 7), holidays=(), bounds=None):
+    '''Return the hours on call per quarter and person, as a list of `Row`.
+
+    Arguments:
+        shifts:    the shifts to analyse.
+        time_zone: the time zone of the roster (for days, nights, weekends).
+        night:     the (start, end) hours of the night.
+        holidays:  the dates of the holidays.
+        bounds:    the (start, end) of the period to analyse: the hours of
+                   the shifts outside of it are not counted [Defaults to
+                   None, the whole shifts].
+    '''
+    spans = [(shift.start, shift.end, shift.name) for shift in shifts]
+    if bounds is not None:
+        spans = [(max(start, bounds[0]), min(end, bounds[1]), name)
+                 for start, end, name in spans]
+    spans = [span for span in spans if span[1] > span[0]]
+    if not spans:
+        return []
+    names = sorted(set(name for start, end, name in spans))
+    indexes = {name: index for index, name in enumerate(names)}
+    person = numpy.array([indexes[name] for start, end, name in spans])
+    starts = numpy.array([timestamp(start) for start, end, name in spans])
+    ends = numpy.array([timestamp(end) for start, end, name in spans])
+    dates, midnights, night_starts, night_ends = local_days(
+        min(span[0] for span in spans), max(span[1] for span in spans),
+        time_zone, night)
+    # Split the shifts in pieces, one per local day they span
+    first = numpy.searchsorted(midnights, starts, side='right') - 1
+    last = numpy.searchsorted(midnights, ends, side='left')
+    counts = last - first
+    piece_shift = numpy.repeat(numpy.arange(len(spans)), counts)
+    offsets = numpy.arange(counts.sum()) - numpy.repeat(
+        numpy.cumsum(counts) - counts, counts)
+    day = first[piece_shift] + offsets
+    start = numpy.maximum(starts[piece_shift], midnights[day])
+    end = numpy.minimum(ends[piece_shift], midnights[day + 1])
+    hours = (end - start) / 3600.0
+    if night[0] > night[1]:  # The night spans midnight
+        night_hours = (
+            overlap(start, end, midnights[day], night_ends[day]) +
+            overlap(start, end, night_starts[day], midnights[day + 1]))
+    else:
+        night_hours = overlap(start, end, night_starts[day], night_ends[day])
+    night_hours /= 3600.0
+    weekend = numpy.array([date.weekday() >= 5 for date in dates])[day]
+    holidays = set(holidays)
+    holiday = numpy.array([date in holidays for date in dates])[day]
+    # Aggregate per (quarter, person)
+    day_quarters = ['{}-Q{}'.format(date.year, (date.month + 2) // 3)
+                    for date in dates]
+    quarters = sorted(set(day_quarters))
+    indexes = {quarter: index for index, quarter in enumerate(quarters)}
+    day_quarter = numpy.array([indexes[quarter] for quarter in day_quarters])
+    group = day_quarter[day] * len(names) + person[piece_shift]
+    size = len(quarters) * len(names)
+    totals = [numpy.bincount(group, weights=weights, minlength=size)
+              for weights in (hours, hours * weekend, night_hours,
+                              hours * holiday)]
+    rows = []
+    for index in numpy.flatnonzero(totals[0]):
+        quarter, name = divmod(index, len(names))
+        rows.append(Row(quarters[quarter], names[name],
+                        *[float(column[index]) for column in totals]))
+    return rows
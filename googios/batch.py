@@ -0,0 +1,163 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+'''
+Group Google API round trips into batch calls.
+
+Calendar listings are grouped into multipart batch requests (one HTTP round
+trip for the first page of up to `batch_size` calendars).  The contacts API
+(gdata) only accepts batch operations on entries whose ID is already known, so
+per-name lookups are instead resolved against the contact feed, downloaded in
+pages of `batch_size` entries, and matched locally - as long as the feed is
+small enough for this to take fewer round trips than the lookups.
+'''
+import re
+from collections import defaultdict
+
+from apiclient.http import BatchHttpRequest
+from gdata.contacts.client import ContactsQuery
+
+from utils import log, dtfy
+from contacts import Person, get_contacts
+
+DEFAULT_BATCH_SIZE = 50  # The maximum number of calls Google accepts per batch
+
+
+def chunks(sequence, size):
+    '''Yield successive `size`-long slices of `sequence`.'''
+    for index in range(0, len(sequence), size):
+        yield sequence[index:index + size]
+
+
+def prefetch_first_pages(calendars, batch_size=DEFAULT_BATCH_SIZE):
+    '''Retrieve the first events page of several calendars in batch calls.
+
+    The pages are stored in each calendar `prefetched` attribute, where
+    `Calendar.get_events` will pick them up instead of issuing a request.
+    Calendars whose request fails are left alone, and will be queried
+    normally.
+    '''
+    by_service = defaultdict(list)
+    for calendar in calendars:
+        by_service[id(calendar.service)].append(calendar)
+    for group in by_service.values():
+        for chunk in chunks(group, batch_size):
+            _prefetch_chunk(chunk)
+
+
+def prefetch_rosters(rosters, batch_size=DEFAULT_BATCH_SIZE):
+    '''Batch-prefetch the calendars of all the `rosters` with a stale cache.'''
+    # Rosters whose breaker is open would not use the prefetched data
+    calendars = [roster.connect() for roster in rosters
+                 if roster.stale and not roster.breaker.is_open]
+    if calendars:
+        prefetch_first_pages(calendars, batch_size)
+
+
+def _prefetch_chunk(calendars):
+    '''Issue a single batch request for the first page of `calendars`.'''
+    keys = {}
+
+    def callback(request_id, response, exception):
+        calendar = calendars[int(request_id)]
+        if exception is not None:
+            msg = 'Batched query failed for calendar "{}": {}'
+            log.warning(msg.format(calendar.cid, exception))
+            return
+        calendar.prefetched[keys[request_id]] = response
+
+    batch = BatchHttpRequest(callback=callback)
+    for counter, calendar in enumerate(calendars):
+        min_end = dtfy(calendar.min_end, as_iso_string=True)
+        max_start = dtfy(calendar.max_start, as_iso_string=True)
+        request_id = str(counter)
+        keys[request_id] = (min_end, max_start, None)
+        batch.add(calendar.list_request(min_end, max_start),
+                  request_id=request_id)
+    log.debug('Issuing batch query for {} calendars'.format(len(calendars)))
+    batch.execute()
+
+
+def _words(contact):
+    '''Return the set of lowercase words identifying a contact.'''
+    texts = []
+    if contact.name is not None:
+        for field in ('full_name', 'given_name', 'family_name'):
+            element = getattr(contact.name, field, None)
+            if element is not None and element.text:
+                texts.append(element.text)
+    if contact.nickname is not None and contact.nickname.text:
+        texts.append(contact.nickname.text)
+    if contact.title is not None and contact.title.text:
+        texts.append(contact.title.text)
+    texts.extend(email.address for email in contact.email)
+    return set(re.findall(r'\w+', ' '.join(texts).lower(), re.UNICODE))
+
+
+def _matches(fuzzy_name, words):
+    '''True if every word of `fuzzy_name` prefixes one of `words`.'''
+    tokens = re.findall(r'\w+', fuzzy_name.lower(), re.UNICODE)
+    return bool(tokens) and all(
+        any(word.startswith(token) for word in words) for token in tokens)
+
+
+def _pages(feed, batch_size):
+    '''Return the number of pages of the contact feed, or None if unknown.'''
+    total = getattr(feed, 'total_results', None)
+    if total is None or not total.text:
+        return None
+    return -(-int(total.text) // batch_size)
+
+
+def resolve_people(client, names, batch_size=DEFAULT_BATCH_SIZE):
+    '''Return a {fuzzy_name: Person} mapping for all resolvable `names`.
+
+    The contact feed is only scanned if it takes fewer round trips than
+    looking the names up one by one: otherwise (or if the size of the feed is
+    unknown) each name is queried with `Person`.  Names matching no contact
+    or more than one are left out of the mapping.
+
+    Note that in the feed the names are matched locally, as prefixes of the
+    words of the name, nickname, title and emails of the contacts: this is
+    close to, but not exactly, the full-text search Google does for `Person`.
+    '''
+    names = list(names)
+    if not names:
+        return {}
+    candidates = {name: [] for name in names}
+    start_index = 1
+    while True:
+        query = ContactsQuery(max_results=batch_size, start_index=start_index)
+        log.debug('Retrieving contacts from #{}'.format(start_index))
+        feed = get_contacts(client, query)
+        if start_index == 1:
+            pages = _pages(feed, batch_size)
+            if pages is None or pages > len(names):
+                log.debug('Contact feed too large, querying names one by one')
+                return _resolve_one_by_one(client, names)
+        entries = feed.entry
+        for contact in entries:
+            words = _words(contact)
+            for name in names:
+                if _matches(name, words):
+                    candidates[name].append(contact)
+        if len(entries) < batch_size:
+            break
+        start_index += batch_size
+    people = {}
+    for name in names:
+        try:
+            people[name] = Person(client, name, candidates[name])
+        except ValueError:
+            pass
+    return people
+
+
+def _resolve_one_by_one(client, names):
+    '''Return a {fuzzy_name: Person} mapping, with a query per name.'''
+    people = {}
+    for name in names:
+        try:
+            people[name] = Person(client, name)
+        except ValueError:
+            pass
+    return people
@@ -0,0 +1,108 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+'''
+Stop querying Google while it is failing.
+
+The state of the breaker is stored on disk (`<roster>.breaker`), so that it is
+shared by all the googios processes working on a roster.  After `threshold`
+consecutive failures the breaker "opens": for `cooldown` minutes no live call
+is attempted and the cache is served straight away.  Once the cooldown is over
+a single process is let through as a "probe": its success closes the breaker,
+its failure opens it for another cooldown.
+'''
+import os
+import json
+import fcntl
+import time
+from contextlib import contextmanager
+
+from utils import log
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half-open'
+
+
+class CircuitBreaker(object):
+
+    '''A circuit breaker persisted in the cache directory.
+
+    Arguments:
+        directory : the directory where the state file is stored
+        name      : the name of the roster
+        threshold : the number of consecutive failures opening the breaker
+        cooldown  : the time (in minutes) the breaker stays open
+    '''
+
+    def __init__(self, directory, name, threshold=3, cooldown=5):
+        self.fname = os.path.realpath(
+            os.path.join(directory, name + '.breaker'))
+        self.threshold = threshold
+        self.cooldown = cooldown * 60
+
+    @contextmanager
+    def _state(self):
+        '''Yield the state of the breaker, holding an exclusive lock on it.
+
+        Changes made to the yielded dictionary are written back to disk.
+        '''
+        fd = os.open(self.fname, os.O_RDWR | os.O_CREAT, 0o644)
+        with os.fdopen(fd, 'r+') as file_:
+            fcntl.flock(file_, fcntl.LOCK_EX)
+            try:
+                state = json.loads(file_.read() or '{}')
+            except ValueError:
+                log.error('Corrupted breaker file "{}"'.format(self.fname))
+                state = {}
+            state.setdefault('state', CLOSED)
+            state.setdefault('failures', 0)
+            original = dict(state)
+            yield state
+            if state != original:
+                file_.seek(0)
+                file_.truncate()
+                file_.write(json.dumps(state, sort_keys=True))
+                file_.flush()
+            # The lock is released when the file is closed
+
+    def allow(self):
+        '''Return True if a live call may be attempted now.'''
+        now = time.time()
+        with self._state() as state:
+            if state['state'] == CLOSED:
+                return True
+            if now - state['since'] < self.cooldown:
+                return False
+            # Cooldown over (or a probe that never reported back): this
+            # process becomes the probe, the others keep using the cache.
+            log.info('Probing Google after {}s of failures'.format(
+                int(now - state['since'])))
+            state['state'] = HALF_OPEN
+            state['since'] = now
+            return True
+
+    def success(self):
+        '''Record a successful live call, closing the breaker.'''
+        with self._state() as state:
+            if state['state'] != CLOSED:
+                log.info('Google is reachable again, closing the breaker')
+            state.clear()
+            state.update(state=CLOSED, failures=0)
+
+    def failure(self):
+        '''Record a failed live call, opening the breaker if needed.'''
+        with self._state() as state:
+            state['failures'] += 1
+            if state['state'] == HALF_OPEN or (
+                    state['state'] == CLOSED and
+                    state['failures'] >= self.threshold):
+                msg = 'Google failed {} times in a row, pausing live calls'
+                log.warning(msg.format(state['failures']))
+                state['state'] = OPEN
+                state['since'] = time.time()
+
+    @property
+    def is_open(self):
+        '''True if live calls are currently suspended.'''
+        with self._state() as state:
+            return state['state'] != CLOSED
@@ -0,0 +1,328 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+'''
+Persist roster rows on disk.
+
+The cache is a TSV file (one shift per row) plus an append-only journal of the
+rows added (`+`) and removed (`-`) since the TSV file was written.  Updates
+that change nothing do not touch the rows at all, small updates only append to
+the journal, and the journal is compacted back into the TSV file once it
+grows too long.
+
+Freshness is not inferred from file modification times, but recorded in a JSON
+sidecar (the "meta" file) together with the window the cache covers and a
+checksum of its rows.
+
+Only the shifts ending in the current month or later are kept in the TSV file
+(the "hot" segment).  Older shifts are archived in one TSV file per month,
+which - the month being over - are written once and only rewritten if Google
+reports a change in the past.  Commands about the present only ever read the
+hot segment, and queries on the past only read the months they span.
+'''
+import os
+import json
+import hashlib
+from datetime import datetime, timedelta
+from collections import Counter
+from cStringIO import StringIO
+
+import pytz
+import unicodecsv as csv
+
+from utils import log, dtfy
+
+# The journal is compacted when it holds more than this many entries *and*
+# more entries than this fraction of the rows in the cache.
+JOURNAL_MIN_ENTRIES = 20
+JOURNAL_MAX_RATIO = 0.5
+
+ADDED = u'+'
+REMOVED = u'-'
+HEADER = u'#'
+
+MONTH_FORMAT = '%Y-%m'
+
+
+def atomic_write(fname, data):
+    '''Replace the content of `fname` with `data` in a single step.'''
+    tmp_fname = '{}.tmp.{}'.format(fname, os.getpid())
+    with open(tmp_fname, 'wb') as file_:
+        file_.write(data)
+        file_.flush()
+        os.fsync(file_.fileno())
+    os.rename(tmp_fname, fname)
+
+
+def month_start(moment):
+    '''Return the beginning of the month `moment` is in.'''
+    return moment.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+
+
+def months_between(start, end):
+    '''Return the (UTC) months overlapping the range `start`-`end`.'''
+    month = month_start(start.astimezone(pytz.UTC))
+    months = [month]
+    while True:
+        month = month_start(month + timedelta(days=32))
+        if month >= end:
+            return months
+        months.append(month)
+
+
+def checksum(rows):
+    '''Return the checksum of a Counter of rows.'''
+    data = serialise(sorted(rows.elements()))
+    return hashlib.sha1(data).hexdigest()
+
+
+def serialise(rows):
+    '''Return the TSV representation of `rows`.'''
+    buffer_ = StringIO()
+    writer = csv.writer(buffer_, delimiter='\t', quoting=csv.QUOTE_NONE)
+    writer.writerows(rows)
+    return buffer_.getvalue()
+
+
+def deserialise(data):
+    '''Return the rows (as tuples) in the TSV string `data`.'''
+    reader = csv.reader(StringIO(data), delimiter='\t',
+                        quoting=csv.QUOTE_NONE)
+    return [tuple(row) for row in reader]
+
+
+class TsvCache(object):
+
+    '''A TSV file with the rows of a roster, patched through a journal.
+
+    Rows are tuples of unicode strings, with an empty string for missing
+    values.  Rows of shifts ended before the current month are moved to the
+    monthly archive files.
+
+    Arguments:
+        directory : the directory where the files are stored
+        name      : the name of the roster
+    '''
+
+    indexed = False  # Whether the backend can answer range queries itself
+
+    def __init__(self, directory, name):
+        self.fname = os.path.realpath(os.path.join(directory, name + '.cache'))
+        self.journal_fname = os.path.splitext(self.fname)[0] + '.journal'
+        self.meta_fname = os.path.splitext(self.fname)[0] + '.meta'
+        self.archive_dir = os.path.splitext(self.fname)[0] + '.archive'
+        self.hot_start = month_start(datetime.now(tz=pytz.UTC))
+        self.corrupted = []  # Ranges whose archived rows had to be dropped
+        self._archived = {}  # The archived months read/written so far
+        self._meta = None
+        self._rows = None  # The rows as last read from/written to disk
+        self._base_checksum = None
+        self._journal_size = 0
+
+    def load(self):
+        '''Return the cached rows.  Raise IOError if there is no cache.'''
+        with open(self.fname, 'rb') as file_:
+            data = file_.read()
+        self._base_checksum = hashlib.sha1(data).hexdigest()
+        rows = Counter(deserialise(data))
+        self._journal_size = 0
+        for entry in self._read_journal():
+            operation, row = entry[0], entry[1:]
+            if operation == ADDED:
+                rows[row] += 1
+            elif rows[row] > 0:
+                rows[row] -= 1
+            self._journal_size += 1
+        self._rows = rows
+        expected = self.read_meta().get('checksum')
+        if expected is not None and expected != self.checksum:
+            log.error('Cache content does not match its checksum')
+            raise ValueError('Cache checksum mismatch.')
+        return list(rows.elements())
+
+    @property
+    def checksum(self):
+        '''Return the checksum of the rows last read from/written to disk.'''
+        return checksum(self._rows)
+
+    def load_range(self, start, end):
+        '''Return the archived rows of the months in `start`-`end` not yet
+        loaded.  Months failing their checksum are listed in `corrupted`.'''
+        end = min(end, self.hot_start)
+        if start >= end:
+            return []
+        rows = Counter()
+        for month in months_between(start, end):
+            key = month.strftime(MONTH_FORMAT)
+            if key not in self._archived:
+                self._archived[key] = self._read_shard(month)
+                rows |= self._archived[key]
+        return list(rows.elements())
+
+    def fingerprint(self, start, end):
+        '''Return the checksums of the (UTC) months overlapping `start`-`end`.
+
+        Checksums are read from the metadata, without loading any row: that
+        of the hot segment stands for all the months from the current one.
+        '''
+        meta = self.read_meta()
+        return [meta.get('archive', {}).get(month.strftime(MONTH_FORMAT))
+                if month < self.hot_start else meta.get('checksum')
+                for month in months_between(start, end)]
+
+    def archived(self, month):
+        '''Return the rows archived for `month` (a Counter), without keeping
+        them loaded.'''
+        return self._read_shard(month)
+
+    def _shard_fname(self, key):
+        '''Return the file name of the archive for the month `key`.'''
+        return os.path.join(self.archive_dir, key + '.cache')
+
+    def _read_shard(self, month):
+        '''Return the rows archived for `month`, as a Counter.'''
+        key = month.strftime(MONTH_FORMAT)
+        try:
+            with open(self._shard_fname(key), 'rb') as file_:
+                rows = Counter(deserialise(file_.read()))
+        except IOError:
+            return Counter()
+        expected = self.read_meta().get('archive', {}).get(key)
+        if expected != checksum(rows):
+            log.error('Archive for {} does not match its checksum'.format(key))
+            self.corrupted.append(
+                (month, month_start(month + timedelta(days=32))))
+            return Counter()
+        return rows
+
+    def _write_shard(self, key, rows):
+        '''Replace the rows archived for the month `key`.'''
+        log.debug('Writing the archive for {}'.format(key))
+        fname = self._shard_fname(key)
+        if not rows:
+            if os.path.exists(fname):
+                os.remove(fname)
+            return
+        if not os.path.isdir(self.archive_dir):
+            os.makedirs(self.archive_dir)
+        atomic_write(fname, serialise(sorted(rows.elements())))
+
+    def read_meta(self):
+        '''Return the metadata of the cache (read from disk only once).'''
+        if self._meta is None:
+            try:
+                with open(self.meta_fname, 'rb') as file_:
+                    self._meta = json.load(file_)
+            except (IOError, ValueError):
+                self._meta = {}
+        return self._meta
+
+    def write_meta(self, meta):
+        '''Store `meta`, completed with the checksum of the cached rows.'''
+        archive = dict(meta.get('archive', {}))
+        for key, rows in self._archived.items():
+            if rows:
+                archive[key] = checksum(rows)
+            else:
+                archive.pop(key, None)
+        meta = dict(meta, checksum=self.checksum, archive=archive)
+        atomic_write(self.meta_fname, json.dumps(meta, sort_keys=True))
+        self._meta = meta
+
+    def _read_journal(self):
+        '''Return the entries of the journal relevant to the current TSV.'''
+        try:
+            with open(self.journal_fname, 'rb') as file_:
+                data = file_.read()
+        except IOError:
+            return []
+        # The last entry may be being appended by another process
+        if not data.endswith('\n'):
+            data = data[:data.rfind('\n') + 1]
+        entries = deserialise(data)
+        # A journal whose header does not match the TSV file is a leftover of
+        # an interrupted compaction: its entries are already in the TSV.
+        if not entries or entries[0] != (HEADER, self._base_checksum):
+            return []
+        return [entry for entry in entries[1:] if entry]
+
+    def save(self, rows):
+        '''Store `rows`, writing only what changed.  Return True on change.
+
+        The archived months that have not been loaded are *not* replaced, but
+        integrated with the rows of `rows` belonging to them.
+        '''
+        hot = []
+        archived = {}
+        for row in rows:
+            end = dtfy(row[1])
+            if end >= self.hot_start:
+                hot.append(row)
+                continue
+            for month in months_between(dtfy(row[0]), end):
+                key = month.strftime(MONTH_FORMAT)
+                archived.setdefault(key, Counter())[row] += 1
+        changed = False
+        for key in set(archived) | set(self._archived):
+            new = archived.get(key, Counter())
+            if key in self._archived:
+                old = self._archived[key]
+            else:
+                month = datetime.strptime(key, MONTH_FORMAT)
+                old = self._read_shard(month.replace(tzinfo=pytz.UTC))
+                new = new | old
+            if checksum(new) != checksum(old):
+                self._write_shard(key, new)
+                changed = True
+            self._archived[key] = new
+        return self._save_hot(hot) or changed
+
+    def _save_hot(self, rows):
+        '''Store the rows of the hot segment.  Return True on change.'''
+        if self._rows is None:
+            try:
+                self.load()
+            except (IOError, ValueError):
+                self._compact(rows)
+                return True
+        new = Counter(rows)
+        added = new - self._rows
+        removed = self._rows - new
+        if not added and not removed:
+            log.debug('Cache content unchanged, skipping write')
+            return False
+        entries = [(REMOVED, ) + row for row in removed.elements()]
+        entries.extend((ADDED, ) + row for row in added.elements())
+        journal_size = self._journal_size + len(entries)
+        if (journal_size > JOURNAL_MIN_ENTRIES and
+                journal_size > JOURNAL_MAX_RATIO * sum(new.values())):
+            self._compact(rows)
+        else:
+            self._append_journal(entries)
+            self._rows = new
+        return True
+
+    def _append_journal(self, entries):
+        '''Append `entries` to the journal (creating it if needed).'''
+        log.debug('Journaling {} changed cache rows'.format(len(entries)))
+        if self._journal_size == 0:
+            data = serialise([(HEADER, self._base_checksum)] + entries)
+            mode = 'wb'
+        else:
+            data = serialise(entries)
+            mode = 'ab'
+        with open(self.journal_fname, mode) as file_:
+            file_.write(data)
+            file_.flush()
+            os.fsync(file_.fileno())
+        self._journal_size += len(entries)
+
+    def _compact(self, rows):
+        '''Write all `rows` to the TSV file and discard the journal.'''
+        log.debug('Writing the full cache')
+        data = serialise(rows)
+        atomic_write(self.fname, data)
+        if os.path.exists(self.journal_fname):
+            os.remove(self.journal_fname)
+        self._base_checksum = hashlib.sha1(data).hexdigest()
+        self._rows = Counter(rows)
+        self._journal_size = 0
@@ -10,15 +10,37 @@ conflict.
 import datetime
 from collections import namedtuple
 
+import dateutil.tz
+import dateutil.parser
+from dateutil.rrule import rrulestr
+from apiclient.errors import HttpError
+
 from utils import log, dtfy
+from metrics import instrument, CALENDAR_PAGES
 
 # This hard limit prevent the query to Google to loop forever, in case there
 # are "repeat forever" recurring events in the calendar
 CACHE_SIZE_HARD_LIMIT = 666
 
+# How far into the future "repeat forever" events are expanded locally, when
+# no `max_start` is given
+RECURRENCE_HORIZON = datetime.timedelta(days=2 * 365)
+
 Event = namedtuple('Event', 'start end fuzzy_name')
 
 
+class NotModified(Exception):
+
+    '''Raised when a conditional listing finds the calendar unchanged.'''
+
+
+def get_tz(name):
+    '''Return the dateutil time zone called `name` (`None` if no name).'''
+    # Unlike pytz ones, dateutil time zones compute the UTC offset from the
+    # wall time, which is what recurrence rules operate on.
+    return dateutil.tz.gettz(name) if name else None
+
+
 class Calendar(object):
 
     '''
@@ -26,14 +48,23 @@ class Calendar(object):
 
     Arguments:
         cid: The `CalendarId` to use
+        expand_recurrences: if True, retrieve recurring events as a single
+                            master event and compute its instances locally,
+                            rather than having Google list every instance.
     '''
 
-    def __init__(self, cid, service, min_end, max_start, all_day_offset=0):
+    def __init__(self, cid, service, min_end, max_start, all_day_offset=0,
+                 expand_recurrences=False):
         self.cid = cid
         self.service = service
         self.min_end = min_end
         self.max_start = max_start
         self.all_day_offset = all_day_offset
+        self.expand_recurrences = expand_recurrences
+        self.prefetched = {}  # First pages retrieved by a batch request
+        self.sync_token = None  # As returned with the last page of events
+        self.etag = None  # As returned with the first page of events
+        self.pages = 0  # Retrieved by the last listing of events
         self.__timezone = False  # `None` may be a valid timezone setting
 
     def __iter__(self):
@@ -45,44 +76,195 @@ class Calendar(object):
             fuzzy_name = event['summary']
             yield start, end, fuzzy_name
 
-    def get_events(self, min_end=None, max_start=None):
+    def list_request(self, min_end, max_start, page_token=None, etag=None):
+        '''Return the (unexecuted) request for a page of the events listing.
+
+        Arguments:
+            min_end:    the minimum finishing ISO datetime for requested events.
+            max_start:  the maximum starting ISO datetime for requested events.
+            page_token: the token of the page to retrieve [`None` is first].
+            etag:       if given, only return the page if its ETag differs.
+        '''
+        if self.expand_recurrences:
+            # Cancelled instances are needed to exclude them from the series
+            request = self.service.events().list(
+                calendarId=self.cid,
+                singleEvents=False,
+                showDeleted=True,
+                timeMin=min_end,
+                timeMax=max_start,
+                pageToken=page_token)
+        else:
+            request = self.service.events().list(
+                calendarId=self.cid,
+                singleEvents=True,
+                timeMin=min_end,
+                timeMax=max_start,
+                orderBy='startTime',
+                pageToken=page_token)
+        if etag is not None:
+            request.headers['If-None-Match'] = etag
+        return request
+
+    def _first_page(self, min_end, max_start, etag=None):
+        '''Return the first page of the listing, or raise NotModified.'''
+        data = self.prefetched.pop((min_end, max_start, None), None)
+        if data is not None:
+            log.debug('Using batch-prefetched page')
+        else:
+            log.debug('Issuing query for the first page')
+            request = self.list_request(min_end, max_start, etag=etag)
+            try:
+                data = request.execute()
+            except HttpError as e:
+                if e.resp.status == 304:
+                    raise NotModified()
+                raise
+        # Prefetched pages are retrieved unconditionally
+        if etag is not None and data.get('etag') == etag:
+            raise NotModified()
+        self.etag = data.get('etag')
+        return data
+
+    @instrument(CALENDAR_PAGES, measure=lambda calendar: calendar.pages)
+    def get_events(self, min_end=None, max_start=None, etag=None):
         '''Retrieve a list of events for a given timespan
 
         Arguments:
             min_end:   the minimum finishing ISO datetime for requested events.
             max_start: the maximum starting ISO datetime for requested events.
+            etag:      the ETag of a previous listing: if the calendar has not
+                       changed since, raise `NotModified`.
         '''
         min_end = dtfy(min_end or self.min_end, as_iso_string=True)
         max_start = dtfy(max_start or self.max_start, as_iso_string=True)
         msg = 'Querying calendar for range: {} to {}'
         log.debug(msg.format(min_end, max_start))
-        page_token = None
-        ret = []
+        self.pages = 0
+        data = self._first_page(min_end, max_start, etag)
+        self.pages = 1
+        items = []
         while True:
-            log.debug('Issuing query with page_token = {}'.format(page_token))
-            events = self.service.events().list(
-                calendarId=self.cid,
-                singleEvents=True,
-                timeMin=min_end,
-                timeMax=max_start,
-                orderBy='startTime',
-                pageToken=page_token)
-            data = events.execute()
-            fix = self.fix_all_day_long_events
-            for event in data['items']:
-                ret.append(Event(fix(event['start']),
-                                 fix(event['end']),
-                                 event['summary']))
+            items.extend(data['items'])
             page_token = data.get('nextPageToken')
-            if not page_token or len(ret) >= CACHE_SIZE_HARD_LIMIT:
+            self.sync_token = data.get('nextSyncToken')
+            if not page_token or len(items) >= CACHE_SIZE_HARD_LIMIT:
                 break
-        return ret
+            log.debug('Issuing query with page_token = {}'.format(page_token))
+            data = self.list_request(min_end, max_start, page_token).execute()
+            self.pages += 1
+        if self.expand_recurrences:
+            return self.expand(items, dtfy(min_end), dtfy(max_start),
+                               data.get('timeZone'))
+        fix = self.fix_all_day_long_events
+        return [Event(fix(event['start']), fix(event['end']), event['summary'])
+                for event in items]
+
+    def expand(self, items, min_end, max_start, time_zone=None):
+        '''Return the events in `items`, with recurring events expanded.
+
+        Arguments:
+            items:     events as returned by Google with `singleEvents=False`.
+            min_end:   the minimum finishing datetime for returned events.
+            max_start: the maximum starting datetime for returned events.
+            time_zone: the default time zone of the calendar.
+        '''
+        max_start = max_start or min_end + RECURRENCE_HORIZON
+        masters = []
+        overridden = set()  # (series id, original start) of modified instances
+        singles = []
+        for item in items:
+            cancelled = item.get('status') == 'cancelled'
+            if cancelled and 'recurringEventId' not in item:
+                continue
+            if 'recurrence' in item:
+                masters.append(item)
+                continue
+            if 'recurringEventId' in item:
+                original = self._to_datetime(item['originalStartTime'])
+                overridden.add((item['recurringEventId'], original))
+                if cancelled:
+                    continue
+            singles.append(item)
+        fix = self.fix_all_day_long_events
+        ret = [Event(fix(item['start']), fix(item['end']), item['summary'])
+               for item in singles]
+        for master in masters:
+            for start, end in self._instances(master, min_end, max_start,
+                                              time_zone):
+                if (master['id'], start) not in overridden:
+                    ret.append(Event(fix(self._to_field(start)),
+                                     fix(self._to_field(end)),
+                                     master['summary']))
+        ret = [event for event in ret
+               if event.end > min_end and event.start < max_start]
+        log.debug('Expanded {} items into {} events'.format(len(items),
+                                                            len(ret)))
+        return sorted(ret)
+
+    def _instances(self, master, min_end, max_start, time_zone):
+        '''Yield (start, end) of the instances of a recurring event.'''
+        start = self._to_datetime(master['start'], time_zone)
+        duration = self._to_datetime(master['end'], time_zone) - start
+        lines = []
+        exdates = []
+        for line in master['recurrence']:
+            if line.startswith(('EXDATE', 'RDATE')):
+                exdates.append(line)
+            else:
+                lines.append(line)
+        rules = rrulestr('\n'.join(lines), dtstart=start, forceset=True)
+        for line in exdates:
+            dates = self._parse_dates(line, time_zone)
+            method = rules.exdate if line.startswith('EXDATE') else rules.rdate
+            for date in dates:
+                method(date)
+        if start.tzinfo is None:  # All-day events have naive dates
+            min_end = min_end.replace(tzinfo=None)
+            max_start = max_start.replace(tzinfo=None)
+        for instance in rules.between(min_end - duration, max_start):
+            yield instance, instance + duration
+
+    def _to_datetime(self, field, time_zone=None):
+        '''Convert a Google start/end field to a datetime.
+
+        Timed events are converted to the time zone of the event (so that
+        recurrences keep the same wall-time across DST changes), all-day
+        events to naive datetimes.
+        '''
+        if field.get('dateTime') is None:
+            return dateutil.parser.parse(field['date'])
+        moment = dateutil.parser.parse(field['dateTime'])
+        tzone = get_tz(field.get('timeZone') or time_zone)
+        return moment.astimezone(tzone) if tzone else moment
+
+    def _to_field(self, moment):
+        '''Convert a datetime to a Google start/end field.'''
+        if moment.tzinfo is None:
+            return {'date': moment.date().isoformat()}
+        return {'dateTime': moment.isoformat()}
+
+    def _parse_dates(self, line, time_zone):
+        '''Return the datetimes listed in an EXDATE or RDATE line.'''
+        # e.g.: "EXDATE;TZID=Europe/Rome:20150105T090000,20150112T090000"
+        header, values = line.split(':', 1)
+        params = dict(param.split('=', 1) for param in header.split(';')[1:])
+        tzone = get_tz(params.get('TZID') or time_zone)
+        dates = []
+        for value in values.split(','):
+            moment = dateutil.parser.parse(value)
+            if params.get('VALUE') == 'DATE':
+                pass
+            elif moment.tzinfo is None and tzone is not None:
+                moment = moment.replace(tzinfo=tzone)
+            dates.append(moment)
+        return dates
 
     def fix_all_day_long_events(self, something):
         '''Shift start date of "all day long" events to match correct start.'''
         # All-day events have start and ending dates filed under the key 'date'
         # rather than 'dateTime'.
-        if something['dateTime'] is not None:
+        if something.get('dateTime') is not None:
             return dtfy(something['dateTime'])
         else:
             date = dtfy(something['date'])
@@ -0,0 +1,94 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+'''
+Check the health of a roster, as a Nagios plugin.
+
+The statistics of the roster are computed once, and compared to the warning
+and critical thresholds of the configuration.  The result is printed in the
+standard plugin format (a status line, followed by performance data), and the
+exit status is the one Nagios expects: 0 (OK), 1 (WARNING), 2 (CRITICAL) or 3
+(UNKNOWN).
+
+Thresholds are `[warning, critical]` pairs, any of which can be `null` to
+never raise that level.  As in the range syntax of the plugins (in which they
+are written to the performance data), a value raises a level if it is beyond
+the threshold: above it, or below it for the metrics where lower is worse
+(written as "threshold:", i.e. "from threshold to infinity").
+'''
+from collections import namedtuple
+
+OK, WARNING, CRITICAL, UNKNOWN = range(4)
+LABELS = ('OK', 'WARNING', 'CRITICAL', 'UNKNOWN')
+
+# A measure of the roster.  `low` is True if the lower the value, the worse.
+Metric = namedtuple('Metric', 'label value uom warning critical low')
+
+
+def level(metric):
+    '''Return the status of `metric`, compared to its thresholds.'''
+    worse = (lambda value, threshold: value < threshold) if metric.low \
+        else (lambda value, threshold: value > threshold)
+    for status, threshold in ((CRITICAL, metric.critical),
+                              (WARNING, metric.warning)):
+        if threshold is not None and worse(metric.value, threshold):
+            return status
+    return OK
+
+
+def perfdata(metric):
+    '''Return the performance data of `metric` ("label=value;warn;crit;0").'''
+    fmt = lambda value: '' if value is None else '{:g}'.format(value)
+    # Thresholds are written as the range of the values that are no problem
+    suffix = ':' if metric.low else ''
+    limit = lambda value: '' if value is None else fmt(value) + suffix
+    return "{}={}{};{};{};0".format(
+        metric.label, fmt(metric.value), metric.uom, limit(metric.warning),
+        limit(metric.critical))
+
+
+def metrics(stats, now, thresholds):
+    '''Return the `Metric` list of a roster, given its `stats`.
+
+    Arguments:
+        thresholds: a {label: [warning, critical]} dictionary, with cache age
+                    thresholds in minutes.
+    '''
+    timestamp = stats['cache.timestamp']
+    cache_age = None if timestamp is None else \
+        int((now - timestamp).total_seconds())
+    to_seconds = lambda pair: [None if value is None else value * 60
+                               for value in pair]
+    ret = [
+        Metric('runway', max((stats['cache.runway'] - now).days, 0), '',
+               *thresholds['runway'], low=True),
+        Metric('holes', len(stats['cache.holes']), '',
+               *thresholds['holes'], low=False),
+    ]
+    if stats['cache.overlaps'] is not None:  # Unknown from freeBusy
+        ret.append(Metric('overlaps', len(stats['cache.overlaps']), '',
+                          *thresholds['overlaps'], low=False))
+    if cache_age is not None:
+        ret.append(Metric('cache_age', cache_age, 's',
+                          *to_seconds(thresholds['cache_age']), low=False))
+    ret.append(Metric('cache_size', stats['cache.size'], '', None, None,
+                      low=False))
+    for name, seconds in sorted(stats['refresh.timings'].items()):
+        ret.append(Metric('refresh_' + name, round(seconds, 3), 's', None,
+                          None, low=False))
+    return ret
+
+
+def check(name, stats, now, thresholds):
+    '''Return (status, output) of the check of roster `name`.'''
+    measures = metrics(stats, now, thresholds)
+    levels = [level(metric) for metric in measures]
+    status = max(levels)
+    problems = [metric for metric, status_ in zip(measures, levels)
+                if status_ != OK]
+    summary = ', '.join('{} {}{}'.format(metric.label, metric.value,
+                                         metric.uom)
+                        for metric in problems or measures[:2])
+    output = 'GOOGIOS {} - {}: {} | {}'.format(
+        LABELS[status], name, summary,
+        ' '.join(perfdata(metric) for metric in measures))
+    return status, output
@@ -0,0 +1,84 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+'''
+Write shifts in machine-readable formats.
+
+Shifts are written as they are stored in the cache (rows of unicode strings,
+with ISO timestamps already formatted), and buffered: the stream is written
+to once every `BUFFER_ROWS` rows.  Together with `Roster.rows`, this allows to
+export years of shifts with constant memory.
+
+Formats:
+    tsv   : tab-separated, with `NA_TOKEN` for missing values (the historical
+            googios output).
+    csv   : comma-separated, with a header and empty missing values.
+    jsonl : one JSON object per line, with null missing values.
+'''
+import sys
+import json
+from collections import OrderedDict
+from cStringIO import StringIO
+
+import unicodecsv as csv
+
+from roster import NA_TOKEN
+
+FIELDS = ('start', 'end', 'name', 'email', 'phone')
+
+FORMATS = ('tsv', 'csv', 'jsonl')
+
+# The number of rows written to the stream at once
+BUFFER_ROWS = 1000
+
+
+class Exporter(object):
+
+    '''Write rows to a stream in one of `FORMATS`.
+
+    Arguments:
+        format_ : the output format
+        fields  : the names of the fields in the rows [Defaults to `FIELDS`]
+        stream  : the stream to write to [Defaults to stdout]
+    '''
+
+    def __init__(self, format_, fields=FIELDS, stream=None):
+        if format_ not in FORMATS:
+            raise ValueError('Unknown format "{}"'.format(format_))
+        self.format = format_
+        self.fields = fields
+        self.stream = stream or sys.stdout
+        self._buffer = StringIO()
+        self._csv = csv.writer(self._buffer, encoding='utf-8')
+        self._count = 0
+        if format_ == 'csv':
+            self._csv.writerow(fields)
+
+    def write(self, row):
+        '''Write a row (a tuple of unicode strings, empty if missing).'''
+        if self.format == 'tsv':
+            line = u'\t'.join(value or NA_TOKEN for value in row)
+            self._buffer.write(line.encode('utf-8') + '\n')
+        elif self.format == 'csv':
+            self._csv.writerow(row)
+        else:
+            record = OrderedDict(
+                (field, value or None) for field, value in zip(self.fields,
+                                                               row))
+            self._buffer.write(json.dumps(record) + '\n')
+        self._count += 1
+        if self._count >= BUFFER_ROWS:
+            self.flush()
+
+    def write_all(self, rows):
+        '''Write all of `rows`, and flush the output.'''
+        for row in rows:
+            self.write(row)
+        self.flush()
+
+    def flush(self):
+        '''Write the buffered rows to the stream.'''
+        self.stream.write(self._buffer.getvalue())
+        self.stream.flush()
+        self._buffer.seek(0)
+        self._buffer.truncate()
+        self._count = 0
@@ -0,0 +1,127 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+'''
+Check when a roster is covered with the Calendar freeBusy endpoint.
+
+`runway` and `status` only need to know *when* the roster calendar is covered,
+not by whom.  A freeBusy query returns the busy periods of a calendar over a
+long window in a single call, which is much cheaper than a full refresh (the
+listing of the events plus the lookup of everybody in them).  The periods are
+stored in `<roster>.busy` and reused for `cache.timeout` minutes, so that
+frequent monitoring checks reach Google at most once per timeout.
+
+Note that freeBusy ignores the events marked as "free" on the calendar, and
+merges overlapping events: overlaps cannot be found on busy periods.
+'''
+import os
+import json
+from datetime import timedelta
+
+from apiclient.http import BatchHttpRequest
+
+from utils import log, dtfy
+from cache import atomic_write
+
+# The longest window Google answers in a single freeBusy query.  Longer
+# windows are split, and the queries sent together in a batch call.
+MAX_SPAN = timedelta(days=60)
+
+
+def windows(start, end):
+    '''Return the (start, end) windows, at most `MAX_SPAN` long, of a range.'''
+    ret = []
+    while start < end:
+        ret.append((start, min(start + MAX_SPAN, end)))
+        start += MAX_SPAN
+    return ret
+
+
+def busy_request(service, cid, start, end):
+    '''Return the (unexecuted) freeBusy request for `cid` in `start`-`end`.'''
+    body = {
+        'timeMin': dtfy(start, as_iso_string=True),
+        'timeMax': dtfy(end, as_iso_string=True),
+        'items': [{'id': cid}],
+    }
+    return service.freebusy().query(body=body)
+
+
+def _periods(response, cid):
+    '''Return the busy (start, end) periods of `cid` in a freeBusy response.'''
+    calendar = response['calendars'][cid]
+    if calendar.get('errors'):
+        reasons = ', '.join(error['reason'] for error in calendar['errors'])
+        raise ValueError('freeBusy failed for "{}": {}'.format(cid, reasons))
+    return [(dtfy(period['start']), dtfy(period['end']))
+            for period in calendar.get('busy', [])]
+
+
+def query_busy(service, cid, start, end):
+    '''Return the busy (start, end) periods of calendar `cid` in a range.
+
+    Raise an exception if any part of the range could not be queried.
+    '''
+    requests = [busy_request(service, cid, window_start, window_end)
+                for window_start, window_end in windows(start, end)]
+    if len(requests) == 1:
+        log.debug('Issuing freeBusy query for "{}"'.format(cid))
+        return _periods(requests[0].execute(), cid)
+    responses = {}
+
+    def callback(request_id, response, exception):
+        responses[int(request_id)] = exception or response
+
+    batch = BatchHttpRequest(callback=callback)
+    for counter, request in enumerate(requests):
+        batch.add(request, request_id=str(counter))
+    msg = 'Issuing batch freeBusy query for "{}" ({} windows)'
+    log.debug(msg.format(cid, len(requests)))
+    batch.execute()
+    periods = []
+    for counter in range(len(requests)):
+        response = responses.get(counter)
+        if response is None or isinstance(response, Exception):
+            raise response or ValueError('No freeBusy response')
+        periods.extend(_periods(response, cid))
+    return periods
+
+
+class BusyPeriods(object):
+
+    '''The busy periods of a roster calendar, as last probed.
+
+    Arguments:
+        directory : the directory where the cache of the roster is stored
+        name      : the name of the roster
+    '''
+
+    def __init__(self, directory, name):
+        self.fname = os.path.realpath(os.path.join(directory, name + '.busy'))
+
+    def read(self, now, timeout):
+        '''Return the periods probed less than `timeout` minutes ago, or None.
+
+        Only the periods not over at `now` are returned.
+        '''
+        try:
+            with open(self.fname) as file_:
+                data = json.load(file_)
+        except (IOError, ValueError):
+            return None
+        if now - dtfy(data['probed_at']) > timedelta(minutes=timeout):
+            return None
+        periods = [(dtfy(start), dtfy(end)) for start, end in data['busy']]
+        return [(start, end) for start, end in periods if end > now]
+
+    def write(self, now, periods):
+        '''Store the busy `periods`, as probed at `now`.'''
+        data = {
+            'probed_at': dtfy(now, as_iso_string=True),
+            'busy': [(dtfy(start, as_iso_string=True),
+                      dtfy(end, as_iso_string=True))
+                     for start, end in periods],
+        }
+        try:
+            atomic_write(self.fname, json.dumps(data, sort_keys=True))
+        except (IOError, OSError) as e:
+            log.error('Cannot store the busy periods: {}'.format(e.strerror))
@@ -6,20 +6,37 @@ Manage your Nagios on-call roster with Google apps.
 Usage:
     googios --help
     googios setup
-    googios <roster> current [start end name email phone] [--echo]
-    googios <roster> query [--start=<start> --end=<end>  | --at=<at>] [--echo]
+    googios <roster> current [start end name email phone] [--format=<format>]
+                             [--echo]
+    googios <roster> query [--start=<start> --end=<end>  | --at=<at>]
+                           [--format=<format>] [--echo]
+    googios <roster> query --at-file=<file> [--echo]
     googios <roster> report [<fuzzy> | <start> <end>] [--echo]
+    googios <roster> analytics [<start> <end>] [--echo]
+    googios <roster> export [<start> <end>] [--format=<format>] [--echo]
     googios <roster> update [--echo]
     googios <roster> runway [--echo]
     googios <roster> status [--echo]
+    googios <roster> check [--echo]
+    googios <roster> schedule [--echo]
+    googios <roster> materialise [--echo]
+    googios <roster> ping [--url=<url>] [--echo]
+    googios coverage <rosters>... [--start=<start> --end=<end>] [--echo]
+    googios chain <rosters>... [--echo]
+    googios watch <rosters>... [--echo]
+    googios metrics <rosters>... [--once] [--echo]
 
 Options:
     -h --help          Show this screen.
     --version          Show version.
     -e --echo          Log to stdout/stderr rather than to the usual file.
     -a --at=<at>       Moment (UTC) in time
+    --at-file=<file>   File with one moment per line ("-" for stdin).
     -f --start=<start>   Minimum ending (UTC) of a shift.
     -t --end=<end>       Maximum starting (UTC) of a shift.
+    --url=<url>        URL of the notifications receiver.
+    --format=<format>  Output format: tsv, csv or jsonl [default: tsv].
+    --once             Print the metrics once, rather than serving them.
 
 The <roster> parameter:
 
@@ -41,6 +58,13 @@ Sub-commands:
              may be inherently ambiguous (see examples below).
                  When running a query programmatically, is safer to use the
              ISO 8601 format (e.g.: 2014-12-09T07:39:22+00:00)
+                 With --at-file, all the moments listed in the file are
+             answered at once (much faster than one query per moment).  Each
+             output line is the moment as read from the file, followed by the
+             shift in progress at that moment.
+                 With --format, shifts are printed as tab-separated values
+             (tsv, the default), comma-separated values with a header (csv) or
+             one JSON object per line (jsonl).
 
     report   Similar to query, but meant for human consumption and with shifts
              grouped by working day.
@@ -50,6 +74,22 @@ Sub-commands:
              example "october" or "apr 2012".
                 `report` groups shifts by day, taking in account the
              "roster.time_shift" parameter in the configuration file.
+                The report of each month that is over is stored in the cache
+             directory, and reused until its shifts change on Google.
+
+    analytics
+             Hours on call per person and per quarter between <start> and
+             <end> (by default the last 12 months), in total and on weekends,
+             at night ("analytics.night" hours) and on holidays (the
+             "analytics.holidays" dates), in the roster time zone.  Meant for
+             checking that the on-call burden is fairly shared.  Requires
+             NumPy.
+
+    export   All shifts between <start> and <end> (by default all the
+             shifts in the cache, without retrieving from Google what lies
+             between them), in the --format of choice.  Unlike `query`,
+             shifts are streamed from the cache one month at a time, so that
+             exports spanning years run in constant memory.
 
     update   Force to rebuild the cache with live data.
 
@@ -61,9 +101,74 @@ Sub-commands:
                  If the time series has "holes" in it, `runway` will return
              the number of full cached days until the first hole, even if more
              shifts have been scheduled afterwards.
+                 With "coverage.freebusy" set, a stale cache is not refreshed:
+             the calendar is probed with a single (much cheaper) freeBusy
+             query instead.
 
     status   Perform a sanity check of the roster.  Print stats and - in case
-             of problems - exit with a non-zero status.
+             of problems - exit with a non-zero status.  Like `runway`, it
+             probes the calendar with freeBusy if "coverage.freebusy" is set,
+             in which case overlaps cannot be detected.
+
+    check    Check the health of the roster as a Nagios plugin: print a
+             status line with performance data (runway days, holes, overlaps,
+             cache age and size, timings of the last refresh), and exit with
+             the plugin status code (0 OK, 1 WARNING, 2 CRITICAL, 3 UNKNOWN).
+             Thresholds are the "check.*" settings.
+
+    schedule Keep the cache fresh, without ever exiting.  The cache is
+             refreshed "schedule.lead" minutes before each handover, and in
+             between at intervals ranging from "cache.timeout" to
+             "schedule.max_interval" minutes, depending on how often the
+             calendar has been found changed.  While the scheduler runs, the
+             other commands consider the cache fresh until the next planned
+             refresh.
+
+    coverage Check the combined coverage of several rosters (e.g.: the
+             rosters of different teams able to answer the same alarms).
+             Print the periods between <start> and <end> in which nobody is
+             on duty in any of the rosters, and exit with a non-zero status
+             if there are any.  <start> defaults to now, <end> to the end of
+             the last cached shift.  Requires NumPy.
+
+    chain    Information on the person on duty in each of several rosters
+             (e.g.: the levels of an escalation chain), one per line and
+             prefixed by the roster name, in the given order.  Each roster
+             uses its own fallback contacts and "current.deadline".
+
+    materialise
+             Write who is on call now and at the next handover to the
+             "<roster>.oncall" file in the cache directory, in a format that
+             can be sourced by shell scripts.  The file is also rewritten at
+             every update of the cache, but as it is only valid until the
+             next handover, this command should be run frequently (e.g.:
+             every minute from crontab).
+
+    watch    Keep the cache of several rosters fresh without polling, never
+             exiting.  A channel is opened on the calendar of each roster,
+             through which Google notifies any change to "watch.address"
+             (which must be a public HTTPS URL, forwarding the notifications
+             to port "watch.port" of this host).  Only the roster that changed
+             is refreshed.  Channels are renewed before they expire, and each
+             roster is refreshed at least every "schedule.max_interval"
+             minutes anyway: until then, the other commands consider the
+             cache fresh.
+
+    metrics  Serve the metrics of several rosters to Prometheus, on port
+             "metrics.port" of this host, never exiting.  For each roster:
+             cache age, runway, holes, overlaps, number of shifts and timings
+             of the last refresh.  Also histograms of the duration of the
+             refreshes, pages per calendar listing, contact request time and
+             cache load time (of the work done by the exporter itself, which
+             refreshes stale rosters in the background: scrapes are answered
+             from the cache as it is).  With --once, print the metrics of the
+             cache and exit (e.g.: for the textfile collector of the node
+             exporter).
+
+    ping     Send a change notification for the channel open on the roster
+             to the `watch` receiver (by default on "watch.port" of this
+             host), like Google would.  Useful to check that the receiver is
+             reachable at <url>.
 
 Examples:
 
@@ -74,24 +179,45 @@ Examples:
     googios dev query --at='12:30'
     googios dev query --start='1 nov' --end='5 nov'
     googios dev query --at='2013-12-11T10:09:08+02:00'
+    googios dev query --at-file=alerts.txt
     googios dev report
     googios dev report august
+    googios dev analytics 2014-01-01 2014-12-31
+    googios dev export --format=jsonl
+    googios dev current name phone --format=csv
     googios dev runway
     googios dev status
+    googios dev check
+    googios dev schedule
+    googios dev materialise
+    googios coverage dev ops --end='1 jan'
+    googios chain dev ops managers
+    googios watch dev ops
+    googios metrics dev ops
+    googios dev ping --url=https://googios.example.com/notifications
 '''
 import os
+import sys
 import json
 import logging
 import datetime
-from random import choice
+import subprocess
 from functools import partial
-from collections import defaultdict
 
 import pytz
 from dateutil.relativedelta import relativedelta
 from docopt import docopt
 
-from roster import Roster, Shift, NA_TOKEN
+from roster import Roster, NA_TOKEN, report_totals
+from intervals import union, AVAILABLE as NUMPY_AVAILABLE
+from batch import DEFAULT_BATCH_SIZE
+from analytics import analyse
+from oncall import who_is_on_call, materialise, chain, Level
+from scheduler import schedule
+from watch import Watcher, ChannelFile, ping
+from export import Exporter, FORMATS
+from check import check, UNKNOWN
+from metrics import serve, render
 from wizard.wizard import Wizard
 from utils import (
     log,
@@ -99,9 +225,42 @@ from utils import (
     log_stream_handler,
     get_calendar_service,
     get_people_client,
-    dtfy
+    dtfy,
+    FAR_FUTURE,
 )
 
+# Settings that were introduced after the first release, and that may thus be
+# missing from older configuration files.
+CONFIG_DEFAULTS = {
+    'batch.size': DEFAULT_BATCH_SIZE,
+    'calendar.expand_recurrences': False,
+    'cache.backend': 'tsv',
+    'current.deadline': None,
+    'breaker.threshold': 3,
+    'breaker.cooldown': 5,
+    'schedule.lead': 10,
+    'schedule.max_interval': 720,
+    'coverage.slot': 1,
+    'coverage.freebusy': False,
+    'analytics.night': [22, 7],
+    'analytics.holidays': [],
+    'watch.address': None,
+    'watch.port': 8080,
+    'watch.ttl': 10080,
+    'check.runway': [14, 7],
+    'check.holes': [0, None],
+    'check.overlaps': [0, None],
+    'check.cache_age': [120, 1440],
+    'metrics.port': 9383,
+}
+
+
+def with_defaults(config):
+    '''Fill in the settings missing from `config` with their default.'''
+    for key, value in CONFIG_DEFAULTS.items():
+        config.setdefault(key, value)
+    return config
+
 
 def load_config(string_):
     '''Load configuration from file.'''
@@ -109,14 +268,14 @@ def load_config(string_):
         with open('{}.config'.format(string_)) as file_:
             config = json.load(file_)
             config['oauth.directory'] = os.path.dirname(string_)
-            return config
+            return with_defaults(config)
     except IOError:
         pass
     try:
         with open(string_) as file_:
             config = json.load(file_)
             config['oauth.directory'] = os.getcwd()
-            return config
+            return with_defaults(config)
     except IOError:
         # The following will always be logged on screen, obviously...
         log.critical('Could not open configuration for "{}"'.format(string_))
@@ -159,35 +318,52 @@ def get_roster(config):
         max_start=max_start,
         all_day_offset=config['roster.time_shift'],
         cache_timeout=config['cache.timeout'],
-        cache_directory=config['cache.directory']
+        cache_directory=config['cache.directory'],
+        cache_backend=config['cache.backend'],
+        batch_size=config['batch.size'],
+        expand_recurrences=config['calendar.expand_recurrences'],
+        breaker_threshold=config['breaker.threshold'],
+        breaker_cooldown=config['breaker.cooldown'],
+        update_clbk=partial(materialise,
+                            fallback_email=config['fallback.email'],
+                            fallback_phone=config['fallback.phone']),
+        coverage_slot=config['coverage.slot'],
+        freebusy=config['coverage.freebusy'],
     )
 
 
+def refresh_in_background(roster, roster_arg):
+    '''Update the roster cache in a detached `googios <roster> update`.
+
+    Nothing is started if the update would be pointless: while another
+    process is refreshing the cache, or while calls to Google are suspended.
+    '''
+    if roster.breaker.is_open:
+        log.info('Google is failing, not updating the roster in background')
+        return
+    if roster.refreshing:
+        log.info('The roster is already being updated by another process')
+        return
+    log.info('Updating the roster in the background')
+    with open(os.devnull, 'r+b') as devnull:
+        subprocess.Popen(
+            [sys.executable, sys.argv[0], roster_arg, 'update'],
+            stdin=devnull, stdout=devnull, stderr=devnull, close_fds=True,
+            preexec_fn=os.setsid)
+
+
+def get_level(roster, config):
+    '''Return the escalation `Level` of `roster`, as per its config.'''
+    deadline = config['current.deadline']
+    if deadline is not None:
+        deadline /= 1000.0  # The setting is in milliseconds
+    return Level(roster, config['fallback.email'], config['fallback.phone'],
+                 deadline)
+
+
 def current(roster, cli, config):
     '''Print information on the current shift in the roster.'''
-    # roster.current return a *list* of all the people on duty
-    shifts = roster.current
-    if len(shifts) == 1:
-        [current] = shifts
-    elif len(shifts) == 0:
-        log.error('Nobody is on duty.')
-        now = datetime.datetime.now(tz=pytz.UTC)
-        current = Shift(now, now, None, None, None)
-    else:
-        log.error('Several people where on duty, picking a random one.')
-        for counter, shift in enumerate(shifts, 1):
-            log.error('On duty #{}: {}'.format(counter, shift))
-        current = choice(shifts)
-    # Replace missing fields with fallback ones
-    if not current.email:
-        current.email = config['fallback.email']
-        if current.name is not None:
-            log.error('Missing email address for "{}"'.format(current.name))
-    if not current.phone:
-        current.phone = config['fallback.phone']
-        if current.name is not None:
-            log.error('Missing phone number for "{}"'.format(current.name))
-    current.name = current.name or 'Fallback Contact Details'
+    current, complete = who_is_on_call(*get_level(roster, config))
     # Compute what fields to output
     fields = ('start', 'end', 'name', 'email', 'phone')
     mask = []
@@ -195,20 +371,73 @@ def current(roster, cli, config):
         mask.append(cli[attr_name])
     if not any(mask):
         mask = [True] * 5  # No explicit field, means all fields
-    bits = [val for val, flag in zip(current.as_string_tuple, mask) if flag]
-    print('\t'.join(bits))
+    exporter = Exporter(cli['--format'],
+                        [name for name, flag in zip(fields, mask) if flag])
+    exporter.write_all(
+        [[val for val, flag in zip(current.as_row, mask) if flag]])
+    if not complete:
+        refresh_in_background(roster, cli['<roster>'])
+
+
+def query_many(roster, cli, config):
+    '''Print the shifts in progress at each of the moments in a file.'''
+    fname = cli['--at-file']
+    try:
+        file_ = sys.stdin if fname == '-' else open(fname)
+    except IOError as e:
+        log.critical('Cannot open "{}": {}'.format(fname, e.strerror))
+        exit(os.EX_NOINPUT)
+    lines = []
+    moments = []
+    with file_:
+        for line in file_:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                moment = dtfy(line, tz=config['roster.time_zone'])
+            except Exception:
+                continue  # Already logged by `dtfy`
+            lines.append(line)
+            moments.append(moment)
+    empty = (NA_TOKEN, ) * 5
+    for line, shifts in zip(lines, roster.at_many(moments)):
+        for shift in shifts or [None]:
+            bits = shift.as_string_tuple if shift else empty
+            print('\t'.join((line, ) + bits))
 
 
 def query(roster, cli, config):
     '''Print a roster query result.'''
+    if cli['--at-file'] is not None:
+        return query_many(roster, cli, config)
     start = cli['--start'] or cli['--at']
     end = cli['--end'] or cli['--at']
     if end < start:
         msg = 'Tried to query roster for a negative timespan ({} to {})'
         log.critical(msg.format(start, end))
         exit(os.EX_DATAERR)
-    for shift in roster.query(start, end):
-        print '\t'.join(shift.as_string_tuple)
+    Exporter(cli['--format']).write_all(roster.rows(start, end, fill))
+
+
+def export(roster, cli, config):
+    '''Stream the shifts in a time bracket (by default the whole cache).'''
+    fill = bool(cli['<start>'])  # The whole cache is exported as it is
+    if cli['<start>']:
+        start = cli['<start>']
+        end = cli['<end>']
+        if start > end:
+            msg = 'Tried to export a negative timespan ({} to {})'
+            log.critical(msg.format(start, end))
+            exit(os.EX_DATAERR)
+    else:
+        start = min([segment[0] for segment in roster.segments] +
+                    [roster.min_end])
+        ends = [end for segment_start, end in roster.segments
+                if end != FAR_FUTURE]
+        ends.extend(shift.end for shift in roster.future_shifts)
+        end = max(ends + [roster.now])
+    Exporter(cli['--format']).write_all(roster.rows(start, end, fill))
 
 
 def report(roster, cli, config):
@@ -239,12 +468,7 @@ def report(roster, cli, config):
         start = now.replace(day=1) + relativedelta(months=-1)
         end = start + relativedelta(months=1, days=-1)
     data = roster.report(start, end)
-    weekdays = defaultdict(int)
-    weekends = defaultdict(int)
-    for day, people in data:
-        target = weekdays if day.weekday() < 5 else weekends
-        for person in people:
-            target[person] += 1
+    weekdays, weekends = report_totals(data)
     print('\n             O N - C A L L   R O S T E R')
     print('=====================================================')
     print('              {} - {}\n\n'.format(start.strftime('%d %b %Y'),
@@ -265,6 +489,36 @@ def report(roster, cli, config):
     print('-----------------------------------------------------\n')
 
 
+def analytics(roster, cli, config):
+    '''Print the hours on call per person and quarter.'''
+    if not NUMPY_AVAILABLE:
+        log.critical('The `analytics` command requires NumPy')
+        exit(os.EX_UNAVAILABLE)
+    if cli['<start>']:
+        start = cli['<start>']
+        end = cli['<end>']
+        if start > end:
+            msg = 'Tried to analyse a negative timespan ({} to {})'
+            log.critical(msg.format(start, end))
+            exit(os.EX_DATAERR)
+    else:
+        end = datetime.datetime.now(tz=pytz.UTC)
+        start = end + relativedelta(years=-1)
+    holidays = [dtfy(day).date() for day in config['analytics.holidays']]
+    rows = analyse(roster.query(start, end), config['roster.time_zone'],
+                   config['analytics.night'], holidays, bounds=(start, end))
+    print('\n          O N - C A L L   A N A L Y T I C S')
+    print('=====================================================')
+    print('              {} - {}\n\n'.format(start.strftime('%d %b %Y'),
+                                             end.strftime('%d %b %Y')))
+    print('  Quarter  Name                Hours  Weekend  Night  Holiday')
+    print('-------------------------------------------------------------')
+    template = '  {:<9}{:<18}{:>7.1f}{:>9.1f}{:>7.1f}{:>9.1f}'
+    for row in rows:
+        print(template.format(row.quarter, row.name or NA_TOKEN, *row[2:]))
+    print('-------------------------------------------------------------\n')
+
+
 def runway(roster, cli, config):
     '''Print the number of days in the future before a shift-less moment.'''
     print (roster.runway - datetime.datetime.now(tz=pytz.UTC)).days
@@ -279,16 +533,25 @@ def status(roster, cli, config):
     # Generation of human-readable statistics
     min_end = human_friendly(stats['roster.min_end'])
     max_start = human_friendly(stats['roster.max_start'])
-    cache_age = datetime.datetime.now(tz=pytz.UTC) - stats['cache.timestamp']
-    cache_age = int(cache_age.total_seconds() / 60)
+    if stats['cache.timestamp'] is None:  # Never built, if probed
+        cache_age = NA_TOKEN
+    else:
+        cache_age = (datetime.datetime.now(tz=pytz.UTC) -
+                     stats['cache.timestamp'])
+        cache_age = int(cache_age.total_seconds() / 60)
     cache_size = stats['cache.size']
+    breaker_open = 'yes' if stats['breaker.open'] else 'no'
     cache_end = human_friendly(stats['cache.end'])
-    num_overlaps = len(stats['cache.overlaps'])
+    source = 'freeBusy' if stats['coverage.probed'] else 'cache'
     num_holes = len(stats['cache.holes'])
-    if num_overlaps:
+    if stats['cache.overlaps'] is None:  # Not known from free/busy periods
+        num_overlaps = first_overlap = NA_TOKEN
+    elif stats['cache.overlaps']:
+        num_overlaps = len(stats['cache.overlaps'])
         first_overlap = map(human_friendly, stats['cache.overlaps'][0])
         exit_status = os.EX_DATAERR
     else:
+        num_overlaps = 0
         first_overlap = NA_TOKEN
     if num_holes:
         first_hole = map(human_friendly, stats['cache.holes'][0])
@@ -301,6 +564,8 @@ def status(roster, cli, config):
     print('  `max_start` query parameter  :  {}'.format(max_start))
     print('  Cache age                    :  {} mins'.format(cache_age))
     print('  Cache size                   :  {} shifts'.format(cache_size))
+    print('  Google calls suspended       :  {}'.format(breaker_open))
+    print('  Coverage checked on          :  {}'.format(source))
     print('  Cache upper limit            :  {}'.format(cache_end))
     print('  Number of roster holes       :  {}'.format(num_holes))
     print('  Roster first hole            :  {}'.format(first_hole))
@@ -309,6 +574,116 @@ def status(roster, cli, config):
     exit(exit_status)
 
 
+def nagios_check(roster, cli, config):
+    '''Print the health of the roster as a Nagios plugin.  Exit accordingly.'''
+    thresholds = {key: config['check.' + key]
+                  for key in ('runway', 'holes', 'overlaps', 'cache_age')}
+    try:
+        stats = roster.stats()
+    except (Exception, SystemExit) as e:
+        msg = 'GOOGIOS UNKNOWN - {}: cannot compute statistics ({})'
+        print(msg.format(roster.name, e.__class__.__name__))
+        exit(UNKNOWN)
+    status, output = check(roster.name, stats, roster.now, thresholds)
+    print(output)
+    exit(status)
+
+
+def coverage(cli):
+    '''Print the holes in the combined coverage of several rosters.'''
+    configs = [load_config(name) for name in cli['<rosters>']]
+    modify_logger(cli, configs[0])
+    if not NUMPY_AVAILABLE:
+        log.critical('The `coverage` command requires NumPy')
+        exit(os.EX_UNAVAILABLE)
+    time_zone = configs[0]['roster.time_zone']
+    rosters = [get_roster(config) for config in configs]
+    start = dtfy(cli['--start'], tz=time_zone) or rosters[0].now
+    end = dtfy(cli['--end'], tz=time_zone) or max(
+        shift.end for roster in rosters for shift in roster.future_shifts)
+    if end <= start:
+        msg = 'Tried to check coverage for a negative timespan ({} to {})'
+        log.critical(msg.format(start, end))
+        exit(os.EX_DATAERR)
+    holes = union(roster.coverage(start, end) for roster in rosters).holes()
+    human_friendly = lambda td: td.isoformat()[:16].replace('T', ' ')
+    print('\n            T E A M   C O V E R A G E')
+    print('=====================================================\n\n')
+    print('  Rosters                      :  {}'.format(
+        ', '.join(roster.name for roster in rosters)))
+    print('  From                         :  {}'.format(human_friendly(start)))
+    print('  To                           :  {}'.format(human_friendly(end)))
+    print('  Number of holes              :  {}\n'.format(len(holes)))
+    for hole_start, hole_end in holes:
+        print('  {}  -  {}'.format(human_friendly(hole_start),
+                                   human_friendly(hole_end)))
+    exit(os.EX_DATAERR if holes else os.EX_OK)
+
+
+def escalation_chain(cli):
+    '''Print the current shift in each of several rosters.'''
+    configs = [load_config(name) for name in cli['<rosters>']]
+    modify_logger(cli, configs[0])
+    levels = [get_level(get_roster(config), config) for config in configs]
+    answers = chain(levels, configs[0]['batch.size'])
+    for level, (shift, complete) in zip(levels, answers):
+        print('\t'.join((level.roster.name, ) + shift.as_string_tuple))
+    for roster_arg, level, (shift, complete) in zip(cli['<rosters>'], levels,
+                                                    answers):
+        if not complete:
+            refresh_in_background(level.roster, roster_arg)
+    exit(os.EX_OK)
+
+
+def watch(cli):
+    '''Refresh several rosters whenever Google notifies a change.'''
+    configs = [load_config(name) for name in cli['<rosters>']]
+    modify_logger(cli, configs[0])
+    address = configs[0]['watch.address']
+    if address is None:
+        log.critical('The `watch` command requires "watch.address"')
+        exit(os.EX_CONFIG)
+    factories = {config['roster.name']: partial(get_roster, config)
+                 for config in configs}
+    watcher = Watcher(factories, address, configs[0]['watch.port'],
+                      configs[0]['watch.ttl'],
+                      configs[0]['schedule.max_interval'])
+    try:
+        watcher.run()
+    except KeyboardInterrupt:
+        log.info('Watch interrupted, channels closed')
+    exit(os.EX_OK)
+
+
+def export_metrics(cli):
+    '''Serve (or print) the metrics of several rosters.'''
+    configs = [load_config(name) for name in cli['<rosters>']]
+    modify_logger(cli, configs[0])
+    factories = {config['roster.name']: partial(get_roster, config)
+                 for config in configs}
+    if cli['--once']:
+        sys.stdout.write(render(factories))
+        exit(os.EX_OK)
+    try:
+        serve(factories, configs[0]['metrics.port'])
+    except KeyboardInterrupt:
+        log.info('Metrics exporter interrupted')
+    exit(os.EX_OK)
+
+
+def send_ping(roster, cli, config):
+    '''Send a test notification to the `watch` receiver of the roster.'''
+    channel = ChannelFile(roster.cache_directory, roster.name).read()
+    if channel is None:
+        msg = 'No channel open on "{}", is `watch` running?'
+        log.critical(msg.format(roster.name))
+        exit(os.EX_UNAVAILABLE)
+    url = cli['--url'] or 'http://localhost:{}/'.format(config['watch.port'])
+    status = ping(url, channel)
+    print('{} {}'.format(url, status))
+    exit(os.EX_OK if status == 200 else os.EX_UNAVAILABLE)
+
+
 def main():
     cli = docopt(__doc__, version='0.1')
     if cli['setup']:
@@ -319,8 +694,19 @@ def main():
         wizard.run()
         logging.disable(logging.NOTSET)
         exit(os.EX_OK)
+    if cli['coverage'] is True:
+        coverage(cli)
+    if cli['chain'] is True:
+        escalation_chain(cli)
+    if cli['watch'] is True:
+        watch(cli)
+    if cli['metrics'] is True:
+        export_metrics(cli)
     config = load_config(cli['<roster>'])
     modify_logger(cli, config)
+    if cli['--format'] not in FORMATS:
+        log.critical('Unknown format "{}"'.format(cli['--format']))
+        exit(os.EX_USAGE)
     for key in ('--start', '--end', '--at', '<start>', '<end>', '<fuzzy>'):
         if cli[key] is not None:
             cli[key] = dtfy(cli[key], tz=config['roster.time_zone'])
@@ -331,12 +717,27 @@ def main():
         query(roster, cli, config)
     elif cli['report'] is True:
         report(roster, cli, config)
+    elif cli['analytics'] is True:
+        analytics(roster, cli, config)
+    elif cli['export'] is True:
+        export(roster, cli, config)
     elif cli['update']:
         roster.update_cache()
     elif cli['runway'] is True:
         runway(roster, cli, config)
     elif cli['status'] is True:
         status(roster, cli, config)
+    elif cli['check'] is True:
+        nagios_check(roster, cli, config)
+    elif cli['materialise'] is True:
+        materialise(roster, config['fallback.email'], config['fallback.phone'])
+    elif cli['ping'] is True:
+        send_ping(roster, cli, config)
+    elif cli['schedule'] is True:
+        schedule(partial(get_roster, config),
+                 lead=config['schedule.lead'],
+                 min_interval=config['cache.timeout'],
+                 max_interval=config['schedule.max_interval'])
     else:
         log.critical('Something is odd, you should never hit this point...')
         exit(os.EX_SOFTWARE)
@@ -0,0 +1,147 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+'''
+Compute the coverage of rosters with NumPy.
+
+A `Coverage` splits a time range at the starts and ends of the shifts, and
+counts how many shifts are in progress between consecutive boundaries.  Holes
+in a roster are then the periods with no shifts, overlaps those with more than
+one, and the runway is the first hole.  Coverages of different rosters over the
+same range can be summed (how many people are on duty across the team) or
+OR-ed (is anybody on duty at all).
+
+NumPy is an optional dependency: `AVAILABLE` tells if it is installed, and the
+roster falls back to computing holes and overlaps on the shifts otherwise.
+'''
+from datetime import timedelta
+
+try:
+    import numpy
+    AVAILABLE = True
+except ImportError:
+    AVAILABLE = False
+
+
+class Coverage(object):
+
+    '''The number of shifts in progress over a time range.
+
+    The range is split at every start and end of a shift, and the shifts in
+    progress are counted between consecutive boundaries: holes and overlaps
+    are exact, however short.
+
+    Arguments:
+        start : the beginning of the range
+        end   : the end of the range
+        slot  : the resolution of the reported holes and overlaps, in minutes
+                (a divisor of 60): their boundaries are rounded outwards to
+                whole slots [Defaults to 1]
+    '''
+
+    def __init__(self, start, end, slot=1):
+        self.start = start
+        self.end = max(start, end)
+        self.slot = slot
+        # The boundaries (in seconds from `start`), and the number of shifts
+        # in progress between each of them and the following one
+        self.points = numpy.unique([0.0, self._offset(self.end)])
+        self.counts = numpy.zeros(len(self.points) - 1, dtype=numpy.int32)
+
+    def _offset(self, moment):
+        '''Return the seconds from the start to `moment`, within the range.'''
+        offset = (moment - self.start).total_seconds()
+        return min(max(offset, 0.0), (self.end - self.start).total_seconds())
+
+    def _moment(self, offset):
+        '''Return the moment `offset` seconds after the start.'''
+        return self.start + timedelta(seconds=float(offset))
+
+    def _counts_on(self, points):
+        '''Return the counts between `points` (a superset of `self.points`).'''
+        # Each period between new points lies within a period between old ones
+        index = numpy.searchsorted(self.points, points[:-1], side='right') - 1
+        return self.counts[index]
+
+    def add(self, intervals):
+        '''Add the (start, end) `intervals` to the coverage.'''
+        intervals = list(intervals)
+        starts = numpy.array([self._offset(start) for start, end in intervals],
+                             dtype=numpy.float64)
+        ends = numpy.array([self._offset(end) for start, end in intervals],
+                           dtype=numpy.float64)
+        points = numpy.union1d(self.points, numpy.concatenate((starts, ends)))
+        # Cumulating +1 at the start of a shift and -1 at its end gives the
+        # number of shifts in progress after each boundary.
+        steps = numpy.zeros(len(points), dtype=numpy.int32)
+        numpy.add.at(steps, numpy.searchsorted(points, starts), 1)
+        numpy.add.at(steps, numpy.searchsorted(points, ends), -1)
+        self.counts = self._counts_on(points) + numpy.cumsum(
+            steps[:-1], dtype=numpy.int32)
+        self.points = points
+        return self
+
+    def _compatible(self, other):
+        '''Raise ValueError if `other` does not span the same range.'''
+        if (self.start, self.end, self.slot) != \
+                (other.start, other.end, other.slot):
+            raise ValueError('Coverages span different ranges.')
+
+    def __add__(self, other):
+        '''Return the coverage with the shifts of both coverages.'''
+        self._compatible(other)
+        ret = Coverage(self.start, self.end, self.slot)
+        ret.points = numpy.union1d(self.points, other.points)
+        ret.counts = self._counts_on(ret.points) + \
+            other._counts_on(ret.points)
+        return ret
+
+    def __or__(self, other):
+        '''Return the coverage with 1 where any of the coverages has shifts.'''
+        ret = self + other
+        ret.counts = (ret.counts > 0).astype(numpy.int32)
+        return ret
+
+    def _round(self, moment, up=False):
+        '''Round `moment` to a whole slot (within the range).'''
+        rounded = moment - timedelta(minutes=moment.minute % self.slot,
+                                     seconds=moment.second,
+                                     microseconds=moment.microsecond)
+        if up and rounded < moment:
+            rounded += timedelta(minutes=self.slot)
+        return min(max(rounded, self.start), self.end)
+
+    def runs(self, mask):
+        '''Return the (start, end) datetimes of the runs of True in `mask`.
+
+        The runs are rounded outwards to whole slots.
+        '''
+        edges = numpy.diff(numpy.concatenate(([0], mask.view(numpy.int8),
+                                              [0])))
+        starts = numpy.flatnonzero(edges == 1)
+        ends = numpy.flatnonzero(edges == -1)
+        return [(self._round(self._moment(self.points[s])),
+                 self._round(self._moment(self.points[e]), up=True))
+                for s, e in zip(starts, ends)]
+
+    def holes(self):
+        '''Return the (start, end) of the periods with nobody on duty.'''
+        return self.runs(self.counts == 0)
+
+    def overlaps(self):
+        '''Return the (start, end) of the periods with several on duty.'''
+        return self.runs(self.counts > 1)
+
+    def first_hole(self):
+        '''Return the beginning of the first hole (or the end of the range).'''
+        empty = numpy.flatnonzero(self.counts == 0)
+        return self._moment(self.points[empty[0]]) if len(empty) else self.end
+
+
+def union(coverages):
+    '''Return the coverage with 1 where any of `coverages` has shifts.'''
+    return reduce(lambda a, b: a | b, coverages)
+
+
+def total(coverages):
+    '''Return the coverage with the shifts of all `coverages`.'''
+    return reduce(lambda a, b: a + b, coverages)
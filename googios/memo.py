@@ -0,0 +1,67 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+'''
+Persist the reports of months that are over.
+
+The report of a month that has ended only changes if the shifts of that month
+are changed on Google, which is rare.  Reports of such months are stored as
+JSON files (`<roster>.reports/YYYY-MM.json`) together with a fingerprint of the
+shifts they were computed from, and reused for as long as the fingerprint
+matches the cache.
+'''
+import os
+import json
+
+from utils import log
+from cache import atomic_write
+
+
+class ReportMemo(object):
+
+    '''The stored reports of a roster.
+
+    Arguments:
+        directory : the directory where the cache of the roster is stored
+        name      : the name of the roster
+    '''
+
+    def __init__(self, directory, name):
+        self.directory = os.path.realpath(
+            os.path.join(directory, name + '.reports'))
+
+    def _fname(self, key):
+        '''Return the file name of the report for the month `key`.'''
+        return os.path.join(self.directory, key + '.json')
+
+    def read(self, key, source):
+        '''Return the per-day names of the month `key`, or None.
+
+        Arguments:
+            source: the fingerprint of the shifts the report must be based on.
+        '''
+        try:
+            with open(self._fname(key)) as file_:
+                memo = json.load(file_)
+        except (IOError, ValueError):
+            return None
+        if memo.get('source') != source:
+            log.debug('Stored report for {} is outdated'.format(key))
+            return None
+        # Names are byte strings everywhere else in the roster
+        return [[name.encode('utf-8') for name in names]
+                for day, names in memo['days']]
+
+    def write(self, key, source, days):
+        '''Store the report of the month `key`.'''
+        log.debug('Storing the report for {}'.format(key))
+        memo = {
+            'source': source,
+            'days': days,
+        }
+        try:
+            if not os.path.isdir(self.directory):
+                os.makedirs(self.directory)
+            atomic_write(self._fname(key), json.dumps(memo, sort_keys=True))
+        except (IOError, OSError) as e:
+            msg = 'Cannot store the report for {}: {}'
+            log.error(msg.format(key, e.strerror))
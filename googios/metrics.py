@@ -0,0 +1,266 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+'''
+Publish the health of rosters to Prometheus.
+
+Two kinds of metrics are exported, in the Prometheus/OpenMetrics text format:
+
+- gauges on the state of each roster (cache age and size, runway, holes,
+  overlaps, timings of the last refresh), computed from `Roster.stats` on the
+  cache as it is at each scrape: scrapes never wait on Google;
+- histograms of how long the work with Google and the cache takes, collected
+  by the instrumented functions of googios (see `instrument`) in the running
+  process - that is: for the refreshes performed by the exporter itself, which
+  refreshes the stale rosters in the background (see `refresh_stale`).
+
+The histograms are kept in memory by this module, so that instrumentation is
+cheap and needs no setup: `render` includes them whenever they have data.
+'''
+import time
+import threading
+from functools import wraps
+from datetime import datetime
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+
+import pytz
+
+from utils import log
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+# Buckets for durations, in seconds
+TIME_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+# Buckets for numbers of pages
+PAGE_BUCKETS = (1, 2, 3, 5, 10, 20)
+
+# How often (in seconds) the exporter looks for stale rosters to refresh
+REFRESH_INTERVAL = 60
+
+
+def _labels(pairs):
+    '''Return the text of a set of labels (e.g.: `{roster="dev"}`).'''
+    if not pairs:
+        return ''
+    escape = lambda value: unicode(value).replace('\\', r'\\').replace(
+        '"', r'\"').replace('\n', r'\n')
+    return '{' + ','.join(u'{}="{}"'.format(name, escape(value))
+                          for name, value in pairs) + '}'
+
+
+class Histogram(object):
+
+    '''A histogram, optionally split by the value of a label.
+
+    Arguments:
+        name    : the name of the metric
+        help_   : the description of the metric
+        buckets : the upper bounds of the buckets (the "+Inf" one is implicit)
+        label   : the name of the label splitting the histogram, if any
+    '''
+
+    def __init__(self, name, help_, buckets, label=None):
+        self.name = name
+        self.help = help_
+        self.buckets = tuple(buckets)
+        self.label = label
+        self._series = {}  # {label value: [bucket counts, sum, count]}
+        self._lock = threading.Lock()
+
+    def observe(self, value, label_value=None):
+        '''Record `value` (in the series of `label_value`).'''
+        with self._lock:
+            series = self._series.setdefault(
+                label_value, [[0] * len(self.buckets), 0.0, 0])
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[0][index] += 1
+            series[1] += value
+            series[2] += 1
+
+    def render(self):
+        '''Return the lines of the histogram, in the text format.'''
+        lines = ['# HELP {} {}'.format(self.name, self.help),
+                 '# TYPE {} histogram'.format(self.name)]
+        with self._lock:
+            series = sorted(self._series.items())
+        for label_value, (counts, total, count) in series:
+            base = [(self.label, label_value)] if self.label else []
+            for bound, bucket in zip(self.buckets, counts):
+                lines.append(u'{}_bucket{} {}'.format(
+                    self.name, _labels(base + [('le', '{:g}'.format(bound))]),
+                    bucket))
+            lines.append(u'{}_bucket{} {}'.format(
+                self.name, _labels(base + [('le', '+Inf')]), count))
+            lines.append(u'{}_sum{} {!r}'.format(self.name, _labels(base),
+                                                 total))
+            lines.append(u'{}_count{} {}'.format(self.name, _labels(base),
+                                                 count))
+        return lines
+
+
+REFRESH_SECONDS = Histogram(
+    'googios_refresh_duration_seconds',
+    'Time taken by updates of the roster cache with live data.',
+    TIME_BUCKETS, label='roster')
+CALENDAR_PAGES = Histogram(
+    'googios_calendar_pages',
+    'Number of pages retrieved per listing of the events of a calendar.',
+    PAGE_BUCKETS)
+CONTACT_SECONDS = Histogram(
+    'googios_contact_request_seconds',
+    'Time taken by the requests to the contacts API (for a single person or '
+    'a page of the contact list).',
+    TIME_BUCKETS)
+CACHE_LOAD_SECONDS = Histogram(
+    'googios_cache_load_seconds',
+    'Time taken by the loading of the roster cache from disk.',
+    TIME_BUCKETS, label='roster')
+
+HISTOGRAMS = (REFRESH_SECONDS, CALENDAR_PAGES, CONTACT_SECONDS,
+              CACHE_LOAD_SECONDS)
+
+
+def instrument(histogram, label=None, measure=None):
+    '''Decorate a method so that each of its calls is observed by `histogram`.
+
+    Arguments:
+        label:   the attribute of the instance giving the label value.
+        measure: a function of the instance returning the value to observe
+                 after the call [Defaults to the duration of the call].
+    '''
+    def decorator(method):
+        @wraps(method)
+        def wrapper(self, *args, **kwargs):
+            started = time.time()
+            try:
+                return method(self, *args, **kwargs)
+            finally:
+                value = (time.time() - started if measure is None
+                         else measure(self))
+                histogram.observe(value, label and getattr(self, label))
+        return wrapper
+    return decorator
+
+
+def roster_gauges(roster):
+    '''Return the {metric name: value} gauges of `roster`, from its cache.'''
+    # The cache as it is, rather than refreshed (or probed) if stale
+    roster.freebusy = False
+    roster.load_cache()
+    stats = roster.stats()
+    now = datetime.now(tz=pytz.UTC)
+    gauges = {
+        'googios_runway_seconds': (stats['cache.runway'] -
+                                   now).total_seconds(),
+        'googios_holes': len(stats['cache.holes']),
+        'googios_shifts': stats['cache.size'],
+        'googios_breaker_open': int(stats['breaker.open']),
+    }
+    if stats['cache.overlaps'] is not None:
+        gauges['googios_overlaps'] = len(stats['cache.overlaps'])
+    if stats['cache.timestamp'] is not None:
+        gauges['googios_cache_age_seconds'] = (
+            now - stats['cache.timestamp']).total_seconds()
+    for phase, seconds in stats['refresh.timings'].items():
+        gauges[('googios_last_refresh_seconds', phase)] = seconds
+    return gauges
+
+
+GAUGES_HELP = {
+    'googios_runway_seconds': 'Time until the first hole in the roster.',
+    'googios_holes': 'Number of future holes in the roster.',
+    'googios_overlaps': 'Number of future overlaps in the roster.',
+    'googios_shifts': 'Number of shifts in the roster cache.',
+    'googios_breaker_open': '1 if calls to Google are suspended.',
+    'googios_cache_age_seconds': 'Time since the last update of the cache.',
+    'googios_last_refresh_seconds': 'Timings of the last update of the cache.',
+    'googios_up': '1 if the statistics of the roster could be computed.',
+}
+
+
+def render(factories):
+    '''Return the metrics of the rosters, and the histograms, as text.
+
+    Arguments:
+        factories: a {name: callback returning a new roster} dictionary.
+    '''
+    samples = {}  # {metric name: [(labels, value), ...]}
+    for name in sorted(factories):
+        up = 1
+        try:
+            gauges = roster_gauges(factories[name]())
+        except (Exception, SystemExit) as e:
+            msg = 'Cannot compute the metrics of "{}": {}'
+            log.error(msg.format(name, e.__class__.__name__))
+            gauges = {}
+            up = 0
+        gauges['googios_up'] = up
+        for key, value in gauges.items():
+            metric, labels = key, [('roster', name)]
+            if isinstance(key, tuple):
+                metric, phase = key
+                labels.append(('phase', phase))
+            samples.setdefault(metric, []).append((labels, value))
+    lines = []
+    for metric in sorted(samples):
+        lines.append('# HELP {} {}'.format(metric, GAUGES_HELP[metric]))
+        lines.append('# TYPE {} gauge'.format(metric))
+        for labels, value in samples[metric]:
+            lines.append(u'{}{} {!r}'.format(metric, _labels(labels),
+                                             float(value)))
+    for histogram in HISTOGRAMS:
+        lines.extend(histogram.render())
+    return (u'\n'.join(lines) + u'\n').encode('utf-8')
+
+
+class _Handler(BaseHTTPRequestHandler):
+
+    '''Serve the metrics of the rosters of the server.'''
+
+    def do_GET(self):
+        if self.path.split('?')[0] not in ('/', '/metrics'):
+            self.send_error(404)
+            return
+        body = render(self.server.factories)
+        self.send_response(200)
+        self.send_header('Content-Type', CONTENT_TYPE)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        log.debug('Exporter: ' + format % args)
+
+
+def refresh_stale(factories, interval=REFRESH_INTERVAL):
+    '''Refresh the rosters whose cache is stale, every `interval` seconds.'''
+    while True:
+        for name in sorted(factories):
+            try:
+                roster = factories[name]()
+                if roster.stale:
+                    roster.update_cache()
+            except (Exception, SystemExit) as e:
+                msg = 'Cannot refresh "{}": {}'
+                log.error(msg.format(name, e.__class__.__name__))
+        time.sleep(interval)
+
+
+def serve(factories, port):
+    '''Serve the metrics of the rosters on `port`, forever.
+
+    The stale rosters are refreshed in a background thread, so that scrapes
+    are answered from the cache straight away.
+    '''
+    refresher = threading.Thread(target=refresh_stale, args=(factories, ),
+                                 name='metrics-refresh')
+    refresher.daemon = True
+    refresher.start()
+    server = HTTPServer(('', port), _Handler)
+    server.factories = factories
+    log.info('Serving metrics on port {}'.format(port))
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
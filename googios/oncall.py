@@ -0,0 +1,204 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+'''
+Work out who should be contacted right now, no matter what.
+
+The person on duty is looked up on the roster (refreshing it if stale) within
+an optional deadline.  Past the deadline the answer comes from the cache as it
+is, or ultimately from the fall-back contact details: paging someone must never
+wait on Google.
+
+The answer can also be "materialised" in a shell-sourceable file next to the
+cache (`<roster>.oncall`), valid until the next handover, so that notification
+scripts can find who is on call without starting Python at all.
+'''
+import os
+import time
+import calendar
+import threading
+from pipes import quote
+from random import choice
+from datetime import timedelta
+from collections import namedtuple
+
+from utils import log, handovers
+from roster import Shift
+from cache import atomic_write
+from batch import prefetch_rosters, DEFAULT_BATCH_SIZE
+
+FIELDS = ('start', 'end', 'name', 'email', 'phone')
+
+# A level of an escalation chain (`deadline` in seconds, or None)
+Level = namedtuple('Level', 'roster fallback_email fallback_phone deadline')
+
+FALLBACK_NAME = 'Fallback Contact Details'
+
+
+def on_duty(shifts, fallback_email, fallback_phone, now):
+    '''Return a new Shift for the person on duty, completed with fallbacks.
+
+    Arguments:
+        shifts: *all* the shifts on duty at `now`.
+    '''
+    if len(shifts) == 1:
+        [current] = shifts
+    elif len(shifts) == 0:
+        log.error('Nobody is on duty.')
+        current = Shift(now, now, None, None, None)
+    else:
+        log.error('Several people where on duty, picking a random one.')
+        for counter, shift in enumerate(shifts, 1):
+            log.error('On duty #{}: {}'.format(counter, shift))
+        current = choice(shifts)
+    # Work on a copy, as the shifts may be shared (e.g.: in the roster data)
+    start, end, name, email, phone = current.as_row
+    if not email:
+        email = fallback_email
+        if name:
+            log.error('Missing email address for "{}"'.format(current.name))
+    if not phone:
+        phone = fallback_phone
+        if name:
+            log.error('Missing phone number for "{}"'.format(current.name))
+    return Shift(start, end, name or FALLBACK_NAME, email, phone)
+
+
+class Lookup(object):
+
+    '''Look up the shifts on duty in `roster`, in a background thread.
+
+    The lookup starts straight away: several lookups (e.g.: on the rosters of
+    an escalation chain) thus run in parallel.
+    '''
+
+    def __init__(self, roster):
+        self.roster = roster
+        self.now = roster.now
+        self.started = time.time()
+        self.shifts = None
+        self._thread = threading.Thread(
+            target=self._run, name='{}-lookup'.format(roster.name))
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _run(self):
+        '''Body of the lookup thread.'''
+        try:
+            self.shifts = self.roster.current
+        except SystemExit:
+            msg = 'Roster lookup for "{}" aborted'
+            log.error(msg.format(self.roster.name))
+        except Exception as e:
+            msg = 'Roster lookup for "{}" failed: {}'
+            log.error(msg.format(self.roster.name, e.__class__.__name__))
+
+    def result(self, fallback_email, fallback_phone, deadline):
+        '''Return (shift, complete), waiting until `deadline` at the latest.
+
+        The deadline is in seconds from the beginning of the lookup.  The
+        lookup is complete unless still running past the deadline: a lookup
+        that failed is complete, even if answered from the cache.
+        '''
+        self._thread.join(max(self.started + deadline - time.time(), 0))
+        shifts = self.shifts
+        if shifts is None:
+            if self._thread.is_alive():
+                msg = 'Roster "{}" not ready in {}s, answering from the cache.'
+                log.warning(msg.format(self.roster.name, deadline))
+            shifts = self.roster.cached_current()
+        shift = on_duty(shifts, fallback_email, fallback_phone, self.now)
+        return shift, not self._thread.is_alive()
+
+
+def who_is_on_call(roster, fallback_email, fallback_phone, deadline=None):
+    '''Return (shift, complete) for the person currently on duty.
+
+    Arguments:
+        deadline: maximum time (in seconds) to wait for the roster.  When it
+                  expires, the answer is based on the cache as it is, and
+                  `complete` is False: the roster lookup (and refresh) keeps
+                  running in a background thread.  Lookups failing before
+                  the deadline are answered from the cache too, but are
+                  complete.  With no deadline the lookup always completes
+                  (or exits, like `Roster` does).
+    '''
+    if deadline is None:
+        now = roster.now
+        shifts = roster.current
+        return on_duty(shifts, fallback_email, fallback_phone, now), True
+    return Lookup(roster).result(fallback_email, fallback_phone, deadline)
+
+
+def chain(levels, batch_size=DEFAULT_BATCH_SIZE):
+    '''Return (shift, complete) for each level of an escalation chain.
+
+    Arguments:
+        levels:     a list of `Level`, from the first to be contacted to the
+                    last.
+        batch_size: max number of calendars refreshed in a single call
+                    [`None` to refresh each roster on its own].
+    '''
+    if all(level.deadline is None for level in levels):
+        # Nothing to wait for: refresh the stale rosters in a single call
+        if batch_size:
+            try:
+                prefetch_rosters([level.roster for level in levels],
+                                 batch_size)
+            except Exception as e:
+                msg = 'Batched prefetch of the rosters failed: {}'
+                log.warning(msg.format(e.__class__.__name__))
+        return [who_is_on_call(*level) for level in levels]
+    # Deadlines run concurrently, from the beginning of the chain lookup
+    lookups = [Lookup(level.roster) if level.deadline is not None else None
+               for level in levels]
+    ret = []
+    for level, lookup in zip(levels, lookups):
+        if lookup is None:
+            ret.append(who_is_on_call(*level))
+        else:
+            ret.append(lookup.result(level.fallback_email,
+                                     level.fallback_phone, level.deadline))
+    return ret
+
+
+def render(roster, current, following, valid_until):
+    '''Return the content of the materialised answer file.'''
+    lines = [
+        '# Who is on call for "{}", as of {}.'.format(
+            roster.name, roster.now.isoformat()),
+        '# Written by googios, do not edit.',
+        'ONCALL_VALID_UNTIL={}'.format(
+            calendar.timegm(valid_until.utctimetuple())),
+    ]
+    for prefix, shift in (('ONCALL', current), ('NEXT', following)):
+        values = shift.as_row if shift else ('', ) * len(FIELDS)
+        for field, value in zip(FIELDS, values):
+            if isinstance(value, unicode):
+                value = value.encode('utf-8')
+            lines.append('{}_{}={}'.format(prefix, field.upper(),
+                                           quote(value)))
+    return '\n'.join(lines) + '\n'
+
+
+def materialise(roster, fallback_email, fallback_phone):
+    '''Write who is on call now and at the next handover to disk.'''
+    now = roster.now
+    current = on_duty(roster.current, fallback_email, fallback_phone, now)
+    future = sorted(roster.future_shifts, key=lambda s: s.as_tuple[:2])
+    upcoming = handovers(((s.start, s.end) for s in future), now)
+    if upcoming:
+        valid_until = upcoming[0]
+    else:
+        valid_until = now + timedelta(minutes=roster.cache_timeout)
+    following = None
+    for shift in future:
+        if shift.start <= valid_until < shift.end:
+            following = shift
+            break
+    fname = os.path.join(roster.cache_directory, roster.name + '.oncall')
+    log.debug('Materialising on-call answer to "{}"'.format(fname))
+    try:
+        atomic_write(fname, render(roster, current, following, valid_until))
+    except (IOError, OSError) as e:
+        msg = 'Cannot write on-call answer file "{}": {}'
+        log.error(msg.format(fname, e.strerror))
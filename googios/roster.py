@@ -4,39 +4,73 @@
 Manage the Shifts, combining information from both calendar and contacts.
 '''
 import os
+import time
+import errno
+import fcntl
+import heapq
+from contextlib import contextmanager
 from datetime import datetime, timedelta
+from collections import Counter, defaultdict
 
 import pytz
-import unicodecsv as csv
 
 from utils import (
     log,
     dtfy,
-    plus_one_day,
+    day_starts,
     merge_intervals,
     find_overlaps,
+    subtract_intervals,
+    FAR_FUTURE,
 )
-from calendars import Calendar
+from calendars import Calendar, NotModified, RECURRENCE_HORIZON
 from contacts import Person
+from batch import resolve_people
+from cache import (
+    TsvCache,
+    month_start,
+    months_between,
+    MONTH_FORMAT,
+)
+from sqlitecache import SqliteCache
+from breaker import CircuitBreaker
+from memo import ReportMemo
+from intervals import Coverage, AVAILABLE as NUMPY_AVAILABLE
+from freebusy import BusyPeriods, query_busy
+from metrics import instrument, REFRESH_SECONDS, CACHE_LOAD_SECONDS
 
 NA_TOKEN = '<n/a>'
 
+CACHE_BACKENDS = {
+    'tsv': TsvCache,
+    'sqlite': SqliteCache,
+}
+
 
 class Shift(object):
 
     '''A single Shift in the Roster.
 
     The class has a "smart" initialisation that can accept both textual data
-    as well as native Python objects'''
+    as well as native Python objects.  Shifts are immutable, so that they can
+    be shared among threads.'''
+
+    __slots__ = ('start', 'end', 'name', 'email', 'phone')
 
     def __init__(self, start, end, name=None, email=None, phone=None):
-        start = dtfy(start)
-        end = dtfy(end)
-        self.start = start
-        self.end = end
-        self.name = None if name is None else name.encode('utf-8')
-        self.email = None if email is None else email.encode('utf-8')
-        self.phone = phone or None
+        values = (
+            dtfy(start),
+            dtfy(end),
+            # Missing values are stored as empty strings in the cache
+            name.encode('utf-8') if name else None,
+            email.encode('utf-8') if email else None,
+            phone or None,
+        )
+        for attr, value in zip(self.__slots__, values):
+            object.__setattr__(self, attr, value)
+
+    def __setattr__(self, attr, value):
+        raise AttributeError('Shift objects are immutable')
 
     def __repr__(self):
         return u'Shift({} {} {} {} {})'.format(*self.as_tuple)
@@ -45,6 +79,14 @@ class Shift(object):
     def as_tuple(self):
         return(self.start, self.end, self.name, self.email, self.phone)
 
+    @property
+    def as_row(self):
+        '''Return the shift as a cache row (a tuple of unicode strings).'''
+        decode = lambda x: u'' if x is None else x.decode('utf-8')
+        return (self.start.isoformat(), self.end.isoformat(),
+                decode(self.name), decode(self.email),
+                u'' if self.phone is None else self.phone)
+
     @property
     def as_string_tuple(self):
         return(self.start.isoformat(), self.end.isoformat(),
@@ -52,6 +94,17 @@ class Shift(object):
                self.phone or NA_TOKEN)
 
 
+def report_totals(lines):
+    '''Return the (weekdays, weekends) days on duty per person in a report.'''
+    weekdays = defaultdict(int)
+    weekends = defaultdict(int)
+    for day, people in lines:
+        target = weekdays if day.weekday() < 5 else weekends
+        for person in people:
+            target[person] += 1
+    return weekdays, weekends
+
+
 class Roster(object):
 
     '''Manage building, loading and caching of a Roster.
@@ -72,11 +125,30 @@ class Roster(object):
         all_day_offset   : offset in hours for "all-day-long" events
                            [Defaults to 0]
         cache_timeout    : cache timeout in minutes [Defaults to 30 minutes]
+        batch_size       : max number of lookups grouped in a single call
+                           [Defaults to `None`, one call per lookup]
+        expand_recurrences : expand recurring events locally
+                           [Defaults to False]
+        cache_backend    : the cache format, one of `CACHE_BACKENDS`
+                           [Defaults to 'tsv']
+        breaker_threshold : consecutive Google failures suspending live calls
+                           [Defaults to 3]
+        breaker_cooldown : minutes live calls stay suspended [Defaults to 5]
+        update_clbk      : a callback called with the roster after each
+                           successful update of the cache [Defaults to None]
+        coverage_slot    : resolution (in minutes) at which holes and overlaps
+                           are reported [Defaults to 1]
+        freebusy         : with a stale cache, check the coverage with a
+                           freeBusy query rather than a full refresh
+                           [Defaults to False]
     '''
 
     def __init__(self, name, cid, cal_service_clbk, ppl_client_clbk,
                  min_end=None, max_start=None, all_day_offset=0,
-                 cache_timeout=30, cache_directory=None):
+                 cache_timeout=30, cache_directory=None, batch_size=None,
+                 expand_recurrences=False, cache_backend='tsv',
+                 breaker_threshold=3, breaker_cooldown=5, update_clbk=None,
+                 coverage_slot=1, freebusy=False):
         # Transfer params to class instance
         self.name = name
         self.cid = cid
@@ -86,6 +158,11 @@ class Roster(object):
         self.max_start = dtfy(max_start)
         self.all_day_offset = all_day_offset
         self.cache_timeout = cache_timeout
+        self.batch_size = batch_size
+        self.expand_recurrences = expand_recurrences
+        self.update_clbk = update_clbk
+        self.coverage_slot = coverage_slot
+        self.freebusy = freebusy
         # Initialised other properties
         self.cal_service = None
         self.ppl_client = None
@@ -93,45 +170,133 @@ class Roster(object):
         self._connected = False
         if cache_directory is None:
             cache_directory = os.getcwd()
-        self.cache_fname = '{}/{}.cache'.format(cache_directory, name)
-        self.cache_fname = os.path.realpath(self.cache_fname)
+        self.cache_directory = cache_directory
+        self.cache = CACHE_BACKENDS[cache_backend](cache_directory, name)
+        self.cache_fname = self.cache.fname
+        self.breaker = CircuitBreaker(cache_directory, name,
+                                      breaker_threshold, breaker_cooldown)
+        self.reports = ReportMemo(cache_directory, name)
+        self.busy = BusyPeriods(cache_directory, name)
+        self.lock_fname = os.path.realpath(
+            os.path.join(cache_directory, name + '.lock'))
+        self._locked = False
         self._data = None
+        self._segments = None
 
     def __iter__(self):
         return self.data
 
     def _init_data(self):
-        '''Initialise the data in the Roster.'''
-        if self.stale:
-            log.debug('Cache is stale.')
-            self.update_cache()
-        else:
-            try:
-                self.load_cache()
-            except IOError:
-                msg = 'Cannot load cache file "{}", try updating.'
-                log.debug(msg.format(self.cache_fname))
-                self.update_cache()
-            except ValueError:
-                log.debug('Trying to update the cache.')
+        '''Initialise the data in the Roster.
+
+        Only one process at a time refreshes a stale cache: meanwhile, the
+        others use the cache as it is, and only wait for the refresh if the
+        cache cannot be loaded at all.
+        '''
+        if not self.stale and self._try_load():
+            return
+        with self._refresh_lock(blocking=False) as locked:
+            if locked:
+                self._reopen_cache()  # It may have just been refreshed
+                if self.stale or not self._try_load():
+                    log.debug('Cache is stale or unusable, updating.')
+                    self.update_cache()
+                return
+        log.info('Cache is being refreshed by another process.')
+        if self._try_load():
+            return
+        with self._refresh_lock():
+            self._reopen_cache()
+            if not self._try_load():
                 self.update_cache()
 
-    def _retrieve_live(self, start, end):
-        '''Load data by querying Google APIs.'''
-        log.info('Retrieving live data for roster: "{}"'.format(self.name))
+    def _try_load(self):
+        '''Load data from the local cache.  Return False if it is unusable.'''
+        try:
+            self.load_cache()
+        except IOError:
+            msg = 'Cannot load cache file "{}".'
+            log.debug(msg.format(self.cache_fname))
+            return False
+        except ValueError:
+            return False
+        return True
+
+    def _reopen_cache(self):
+        '''Forget what was read from the cache, as it may have changed.'''
+        self.cache = type(self.cache)(self.cache_directory, self.name)
+        self._segments = None
+
+    @contextmanager
+    def _refresh_lock(self, blocking=True):
+        '''Hold the lock on refreshes of the cache, shared by all processes.
+
+        Yield True, or False if the lock is held elsewhere and not `blocking`.
+        '''
+        if self._locked:  # Already held by this roster
+            yield True
+            return
+        fd = os.open(self.lock_fname, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX |
+                            (0 if blocking else fcntl.LOCK_NB))
+            except IOError as e:
+                if e.errno not in (errno.EAGAIN, errno.EACCES):
+                    raise
+                yield False
+                return
+            self._locked = True
+            try:
+                yield True
+            finally:
+                self._locked = False
+        finally:
+            os.close(fd)  # Releases the lock
+
+    @property
+    def refreshing(self):
+        '''True if the cache is being refreshed by another process.'''
+        if self._locked:  # By this roster (e.g.: in a lookup thread)
+            return False
+        fd = os.open(self.lock_fname, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError as e:
+            if e.errno not in (errno.EAGAIN, errno.EACCES):
+                raise
+            return True
+        finally:
+            os.close(fd)  # Releases the lock, if acquired
+        return False
+
+    def connect(self):
+        '''Instantiate the Google service/client and return the calendar.'''
         if not self._connected:
-            cal_service = self.cal_service_clbk()
+            self.cal_service = self.cal_service_clbk()
             self.ppl_client = self.ppl_client_clbk()
-            self.calendar = Calendar(self.cid, cal_service, self.min_end,
-                                     self.max_start, self.all_day_offset)
-        events = self.calendar.get_events(start, end)
+            self.calendar = Calendar(self.cid, self.cal_service, self.min_end,
+                                     self.max_start, self.all_day_offset,
+                                     self.expand_recurrences)
+            self._connected = True
+        return self.calendar
+
+    def _retrieve_live(self, start, end, etag=None):
+        '''Load data by querying Google APIs.'''
+        log.info('Retrieving live data for roster: "{}"'.format(self.name))
+        self.connect()
+        events = self.calendar.get_events(start, end, etag)
         ppl_names = set([event.fuzzy_name for event in events])
-        ppl_cache = {}
-        for name in ppl_names:
-            try:
-                ppl_cache[name] = Person(self.ppl_client, name)
-            except ValueError:
-                pass
+        if self.batch_size:
+            ppl_cache = resolve_people(
+                self.ppl_client, ppl_names, self.batch_size)
+        else:
+            ppl_cache = {}
+            for name in ppl_names:
+                try:
+                    ppl_cache[name] = Person(self.ppl_client, name)
+                except ValueError:
+                    pass
         rows = []
         for event in events:
             row = list(event)
@@ -143,111 +308,494 @@ class Roster(object):
         log.debug(msg.format(len(rows), self.name))
         return rows
 
-    def _get_from_google(self, start=None, end=None):
+    def _get_from_google(self, start=None, end=None, etag=None):
         '''A wrapper that catches any I/O exception and keep going.'''
+        if not self.breaker.allow():
+            log.warning('Google is failing, skipping live retrieval.')
+            return None
         try:
-            return self._retrieve_live(start, end)
+            shifts = self._retrieve_live(start, end, etag)
+        except NotModified:
+            self.breaker.success()
+            raise
         except Exception as e:
+            self.breaker.failure()
             msg = 'Fatal error while retrieving data from Google: {}'
             log.error(msg.format(e.__class__.__name__))
+            return None
+        self.breaker.success()
+        return shifts
 
     def _save_cache(self):
         '''Save a local copy of all the future shifts in the roster.'''
-        with open(self.cache_fname, 'wb') as file_:
-            log.info('Saving cache for "{}"'.format(self.name))
-            writer = csv.writer(file_, delimiter='\t', quoting=csv.QUOTE_NONE)
-            writer.writerows([shift.as_tuple for shift in self._data])
+        log.info('Saving cache for "{}"'.format(self.name))
+        if not self.cache.save([shift.as_row for shift in self._data]):
+            log.info('No changes in the roster since the last update')
 
+    @instrument(CACHE_LOAD_SECONDS, label='name')
     def load_cache(self):
         '''Load data from the local cache.'''
-        with open(self.cache_fname, 'rb') as file_:
-            log.info('Building roster for "{}" from cache'.format(self.name))
-            reader = csv.reader(file_, delimiter='\t', quoting=csv.QUOTE_NONE)
-            data = [Shift(*row) for row in reader]
-            if not data:
-                log.error('Cache is empty')
-                raise ValueError('Cache is empty.')
-            self._data = data
-
+        rows = self.cache.load()
+        log.info('Building roster for "{}" from cache'.format(self.name))
+        data = [Shift(*row) for row in rows]
+        if not data:
+            log.error('Cache is empty')
+            raise ValueError('Cache is empty.')
+        self._data = sorted(data, key=lambda shift: shift.as_tuple[:2])
+
+    def _save_meta(self, **changes):
+        '''Record the freshness and scope of the cached data.'''
+        meta = dict(self.meta)
+        meta.update(changes)
+        meta['segments'] = [
+            (dtfy(start, as_iso_string=True), dtfy(end, as_iso_string=True))
+            for start, end in merge_intervals(self.segments)]
+        self.cache.write_meta(meta)
+
+    def update_meta(self, **changes):
+        '''Add `changes` to the metadata of the cache (e.g.: refresh plans).
+
+        The metadata also records the checksum of the cached rows: the cache
+        is reloaded under the refresh lock, so that the changes are recorded
+        against its latest content, even if another process has refreshed it
+        in the meantime.
+        '''
+        with self._refresh_lock():
+            self._reopen_cache()
+            self._data = None
+            if not self._try_load():
+                msg = 'Cannot load cache of "{}", metadata not updated.'
+                log.warning(msg.format(self.name))
+                return
+            self._save_meta(**changes)
+
+    def _merge_live(self, shifts, start, end):
+        '''Replace the shifts overlapping `start`-`end` with `shifts`.'''
+        inside = lambda s: s.end > start and s.start < end
+        kept = [shift for shift in self._data or [] if not inside(shift)]
+        data = kept + shifts
+        self._data = sorted(data, key=lambda shift: shift.as_tuple[:2])
+        self.segments.append((start, end))
+
+    def _forget(self, start, end):
+        '''Remove the range `start`-`end` from the cached segments.'''
+        self._segments = [
+            gap for segment in self.segments
+            for gap in subtract_intervals(segment[0], segment[1],
+                                          [(start, end)])]
+
+    def _load_archive(self, start, end):
+        '''Add the archived shifts overlapping `start`-`end` to the data.'''
+        rows = self.cache.load_range(start, end)
+        for corrupted in self.cache.corrupted:
+            self._forget(*corrupted)
+        self.cache.corrupted = []
+        if not rows:
+            return
+        known = set(shift.as_row for shift in self._data)
+        data = self._data + [Shift(*row) for row in set(rows) - known]
+        self._data = sorted(data, key=lambda shift: shift.as_tuple[:2])
+
+    @instrument(REFRESH_SECONDS, label='name')
     def update_cache(self):
-        '''Update the Roster with live data.'''
-        data = self._get_from_google()
+        '''Update the Roster with live data.
+
+        Updates are serialised among processes by the refresh lock.  The
+        timings of successful updates are recorded in the metadata, as
+        `timings`: the seconds spent querying Google and in the whole update.
+        '''
+        with self._refresh_lock():
+            self._update_cache()
+
+    def _update_cache(self):
+        '''Update the Roster with live data (see `update_cache`).'''
+        started = time.time()
+        window = (self.min_end, self.max_start or FAR_FUTURE)
+        loaded = True  # Whether the data includes the hot segment of the cache
+        if self._data is None:
+            # Shifts out of the window (e.g.: filled by previous queries) must
+            # be preserved
+            try:
+                self.load_cache()
+            except (IOError, ValueError):
+                loaded = False
+                self._forget(self.cache.hot_start, FAR_FUTURE)
+                self._data = []
+        self._load_archive(*window)
+        # Only a cache whose hot segment could be loaded can be revalidated
+        # (the data may otherwise only hold archived months)
+        etag = self.meta.get('etag') if loaded else None
+        querying = time.time()
+        try:
+            data = self._get_from_google(etag=etag)
+        except NotModified:
+            log.info('No changes in the calendar since the last update')
+            self._save_meta(fetched_at=self.now.isoformat(), timings={
+                'google': time.time() - querying,
+                'total': time.time() - started})
+            # The far end of the window moves with time: retrieve the part
+            # of it not yet cached, unless it is negligibly small.
+            tolerance = timedelta(minutes=self.cache_timeout)
+            if any(gap_end - gap_start > tolerance
+                   for gap_start, gap_end in self.missing(*window)):
+                self.fill(*window)
+            self._updated()
+            return
+        google = time.time() - querying
         # If the previous operation fails, use cached data.
         if data:
-            self._data = data
+            self._merge_live(data, *window)
             self._save_cache()
-        else:
+            self._save_meta(
+                fetched_at=self.now.isoformat(),
+                min_end=dtfy(self.min_end, as_iso_string=True),
+                max_start=dtfy(self.max_start, as_iso_string=True),
+                sync_token=self.calendar.sync_token,
+                etag=self.calendar.etag,
+                timings={'google': google, 'total': time.time() - started})
+            self._updated()
+        elif loaded:
+            # The data already holds the cache (and the archived months)
             log.warning('Cache update failed, using stale cache instead.')
-            try:
-                self.load_cache()
-            except (IOError, ValueError):
-                msg = 'Cannot connect to Google nor load cache. Panic!'
-                log.critical(msg)
-                exit(os.EX_IOERR)
+        else:
+            msg = 'Cannot connect to Google nor load cache. Panic!'
+            log.critical(msg)
+            exit(os.EX_IOERR)
+
+    def _updated(self):
+        '''Notify `update_clbk` (if any) of an update of the cache.'''
+        if self.update_clbk is not None:
+            self.update_clbk(self)
+
+    def missing(self, start, end):
+        '''Return the parts of the range `start` to `end` not in the cache.'''
+        if end <= start:
+            end = start + timedelta(minutes=1)  # Point queries
+        return subtract_intervals(start, end, self.segments)
+
+    def covers(self, start, end):
+        '''True if the cache includes the whole range `start` to `end`.'''
+        return not self.missing(start, end)
+
+    def fill(self, start, end):
+        '''Retrieve from Google the parts of a range missing from the cache.'''
+        if self.covers(start, end):
+            return
+        held = self._locked  # E.g.: filling in the window of an update
+        with self._refresh_lock():
+            if not held:
+                # Another process may have changed the cache meanwhile
+                self._reopen_cache()
+                self._data = None
+                if self.covers(start, end):
+                    return
+            self.data  # Make sure the cache is loaded before merging into it
+            # Only the archived months around the gaps are merged into (the
+            # range may span years of cached shifts)
+            for gap_start, gap_end in self.missing(start, end):
+                self._load_archive(gap_start, gap_end)
+            for gap_start, gap_end in self.missing(start, end):
+                msg = ('Range "{} to {}" is outside of cache scope, '
+                       'retrieving it.')
+                log.info(msg.format(gap_start, gap_end))
+                shifts = self._get_from_google(gap_start, gap_end)
+                if shifts is None:
+                    log.warning(
+                        'Could not retrieve shifts, results are partial.')
+                    return
+                self._merge_live(shifts, gap_start, gap_end)
+            self._save_cache()
+            self._save_meta()
 
     def query(self, start, end):
         '''Return all shifts in a given time bracket.'''
-        if start < self.min_end or (self.max_start and end > self.max_start):
-            msg = 'Range "{} to {}"" is outside of cache scope "{} to {}".'
-            data = (start, end, self.min_end, self.max_start)
-            args = [dtfy(x) for x in data]
-            log.warning(msg.format(*args))
-            shifts = self._get_from_google(start, end)
-        else:
-            func = lambda s: s.end > start and s.start < end
-            shifts = [shift for shift in self.data if func(shift)]
-        return shifts
+        self.fill(start, end)
+        if self.indexed:
+            return [Shift(*row) for row in self.cache.between(start, end)]
+        self.data  # Make sure the hot segment of the cache is loaded
+        self._load_archive(start, end)
+        func = lambda s: s.end > start and s.start < end
+        return [shift for shift in self._data if func(shift)]
+
+    def rows(self, start, end, fill=True):
+        '''Yield the cache rows of the shifts in a time bracket, by start.
+
+        Unlike `query`, the cache is read one month at a time, and the rows
+        are not turned into `Shift` objects: memory use does not grow with
+        the length of the bracket, and timestamps are already formatted.
+
+        Arguments:
+            fill: retrieve from Google the parts of the bracket missing from
+                  the cache, rather than only yielding the cached shifts.
+        '''
+        if fill:
+            self.fill(start, end)
+        indexed = self.indexed
+        if not indexed:
+            self.data  # Make sure the hot segment of the cache is loaded
+        first = True
+        for month in months_between(start, end):
+            chunk_start = max(month, start)
+            chunk_end = min(month_start(month + timedelta(days=32)), end)
+            if self.missing(chunk_start, chunk_end) == [(chunk_start,
+                                                         chunk_end)]:
+                continue  # Nothing cached for this month
+            if indexed:
+                rows = self.cache.between(chunk_start, chunk_end)
+            else:
+                rows = Counter(
+                    shift.as_row for shift in self._data
+                    if shift.end > chunk_start and shift.start < chunk_end)
+                if month < self.cache.hot_start:
+                    rows |= self.cache.archived(month)
+                rows = rows.elements()
+            keyed = []
+            for row in rows:
+                row_start, row_end = dtfy(row[0]), dtfy(row[1])
+                # Shifts across months are only yielded with the first one
+                if row_end > chunk_start and row_start < chunk_end and \
+                        (first or row_start >= chunk_start):
+                    keyed.append(((row_start, row_end), row))
+            for key, row in sorted(keyed):
+                yield row
+            first = False
+
+    def at_many(self, moments):
+        '''Return the list of shifts in progress at each of `moments`.
+
+        A shift is in progress from its start (included) to its end
+        (excluded), so that only the incoming shift is returned at handovers.
+        The moments are answered in a single pass over the shifts.
+        '''
+        if not moments:
+            return []
+        order = sorted(range(len(moments)), key=moments.__getitem__)
+        first = moments[order[0]]
+        last = moments[order[-1]] + timedelta(minutes=1)
+        shifts = sorted(self.query(first, last),
+                        key=lambda shift: shift.as_tuple[:2])
+        answers = [None] * len(moments)
+        active = []  # Heap of (end, position, shift) of the started shifts
+        position = 0
+        for index in order:
+            moment = moments[index]
+            while position < len(shifts) and \
+                    shifts[position].start <= moment:
+                shift = shifts[position]
+                heapq.heappush(active, (shift.end, position, shift))
+                position += 1
+            while active and active[0][0] <= moment:
+                heapq.heappop(active)
+            # Keep the shifts sorted by start, as returned by `query`
+            answers[index] = [item[2] for item in
+                              sorted(active, key=lambda item: item[1])]
+        return answers
 
     def report(self, start, end):
-        '''Return a report in the form [(date, [persA, persB, ...]), ...]'''
+        '''Return a report in the form [(date, [persA, persB, ...]), ...]
+
+        The reports of whole months that are over are stored, and reused for
+        as long as the shifts of the month do not change.
+        '''
         # `report` works with dates/days not times, so we discard time info...
         start = start.tzinfo.normalize(start)
         end = end.tzinfo.normalize(end)
-        offset = timedelta(hours=self.all_day_offset)
-        datify = lambda x: datetime(x.year, x.month, x.day,
-                                    tzinfo=x.tzinfo) + offset
-        start = datify(start)
-        # We want the report to be inclusive of both start and end, so end +1
-        end = datify(end)
+        # We want the report to be inclusive of both start and end
+        starts = day_starts(start.tzinfo.zone, start.date(), end.date(),
+                            self.all_day_offset)
+        months = []  # [(YYYY-MM, [(day_start, day_end), ...]), ...]
+        for day in zip(starts[:-1], starts[1:]):
+            key = day[0].date().strftime(MONTH_FORMAT)
+            if not months or months[-1][0] != key:
+                months.append((key, []))
+            months[-1][1].append(day)
+        stored = {}
+        sources = {}
+        for key, days in months:
+            if self._closed_month(days):
+                sources[key] = self._report_source(days)
+                if sources[key] is None:
+                    continue
+                names = self.reports.read(key, sources[key])
+                if names is not None and len(names) == len(days):
+                    stored[key] = names
+        computed = iter(self._names_by_day(
+            [day for key, days in months if key not in stored
+             for day in days]))
         lines = []
-        while start <= end:
-            day_end = plus_one_day(start)
-            shifts = self.query(start, day_end)
-            lines.append((start.date(), [shift.name for shift in shifts]))
-            start = day_end
+        for key, days in months:
+            if key in stored:
+                names = stored[key]
+            else:
+                names = [next(computed) for day in days]
+                if key in sources:
+                    self._store_report(key, sources[key], days, names)
+            lines.extend((day_start.date(), people)
+                         for (day_start, day_end), people in zip(days, names))
         return lines
 
+    def _names_by_day(self, days):
+        '''Return the names of the people on duty for each of `days`.'''
+        if not days:
+            return []
+        # Retrieve any missing day in one go, rather than one day at a time
+        self.fill(days[0][0], days[-1][1])
+        if self.indexed:
+            return self.cache.names_by_day(days)
+        return [[shift.name for shift in self.query(day_start, day_end)]
+                for day_start, day_end in days]
+
+    def _closed_month(self, days):
+        '''True if `days` are all the days of a month that is over.'''
+        first = days[0][0].date()
+        after_last = days[-1][0].date() + timedelta(days=1)
+        return first.day == 1 and after_last.day == 1 and \
+            days[-1][1] <= self.now
+
+    def _report_source(self, days):
+        '''Return the fingerprint of the shifts a report on `days` uses.'''
+        start, end = days[0][0], days[-1][1]
+        if not self.covers(start, end):
+            return None  # The report will be computed on live data
+        return {
+            'checksums': self.cache.fingerprint(start, end),
+            'time_zone': str(start.tzinfo),
+            'all_day_offset': self.all_day_offset,
+        }
+
+    def _store_report(self, key, source, days, names):
+        '''Store the report of the month `key`, if based on cached data.'''
+        if source is None:
+            # The fingerprint of data just retrieved live
+            source = self._report_source(days)
+        if source is None:
+            return
+        self.reports.write(key, source,
+                           [[day_start.date().isoformat(), people]
+                            for (day_start, day_end), people
+                            in zip(days, names)])
+
+    def coverage(self, start, end):
+        '''Return the `Coverage` of the shifts between `start` and `end`.'''
+        intervals = [(s.start, s.end) for s in self.query(start, end)]
+        return Coverage(start, end, self.coverage_slot).add(intervals)
+
+    def _probe(self):
+        '''Return the future busy periods of the calendar, or None.
+
+        The periods are queried to Google with freeBusy (without contacts
+        lookups) unless probed less than `cache_timeout` minutes ago.
+        '''
+        now = self.now
+        periods = self.busy.read(now, self.cache_timeout)
+        if periods is not None:
+            log.debug('Using the busy periods probed recently')
+            return periods
+        if not self.breaker.allow():
+            log.warning('Google is failing, skipping freeBusy query.')
+            return None
+        service = (self.cal_service if self._connected
+                   else self.cal_service_clbk())
+        end = self.max_start or now + RECURRENCE_HORIZON
+        try:
+            periods = query_busy(service, self.cid, now, end)
+        except Exception as e:
+            self.breaker.failure()
+            msg = 'Error while querying freeBusy from Google: {}'
+            log.error(msg.format(e.__class__.__name__))
+            return None
+        self.breaker.success()
+        self.busy.write(now, periods)
+        return periods
+
+    def _future_intervals(self):
+        '''Return the future (start, end) covered, and if probed by freeBusy.
+
+        With a stale cache (and `freebusy` set) the periods come from a
+        freeBusy probe, and the cache is not refreshed.  Should the probe
+        fail, the cache is refreshed as usual.
+        '''
+        if self.freebusy and self.stale:
+            periods = self._probe()
+            if periods is not None:
+                return periods, True
+        return [(s.start, s.end) for s in self.future_shifts], False
+
+    def _cache_size(self, probed):
+        '''Return the number of shifts in the cache.'''
+        if self.indexed or (probed and self.cache.indexed):
+            return self.cache.count()
+        if probed:  # The cache is not to be refreshed
+            try:
+                return len(self.cache.load())
+            except (IOError, ValueError):
+                return 0
+        return len(self.data)
+
     def stats(self):
-        '''Return statistics on the roster.'''
-        intervals = merge_intervals(
-            [(s.start, s.end) for s in self.future_shifts])
-        if len(intervals) < 2:
+        '''Return statistics on the roster.
+
+        Overlaps are `None` if the coverage was probed with freeBusy, as busy
+        periods are merged by Google.
+        '''
+        now = self.now
+        future, probed = self._future_intervals()
+        # The cache end is the max end of any interval
+        cache_end = max(end for start, end in future) if future else None
+        if not future:  # e.g.: freeBusy found no busy period
             holes = []
+            overlaps = []
+        elif NUMPY_AVAILABLE:
+            cover = Coverage(min(future)[0], cache_end,
+                             self.coverage_slot).add(future)
+            holes = cover.holes()
+            overlaps = cover.overlaps()
         else:
-            h_starts = (i[1] for i in intervals[:-1])
-            h_ends = (i[0] for i in intervals[1:])
-            holes = zip(h_starts, h_ends)
-        overlaps = find_overlaps(
-            [(s.start, s.end) for s in self.future_shifts])
+            intervals = merge_intervals(future)
+            if len(intervals) < 2:
+                holes = []
+            else:
+                h_starts = (i[1] for i in intervals[:-1])
+                h_ends = (i[0] for i in intervals[1:])
+                holes = zip(h_starts, h_ends)
+            overlaps = find_overlaps(future)
+        if probed:
+            overlaps = None
         stats = {
             'roster.min_end': self.min_end,
             'roster.max_start': self.max_start,
-            'cache.size': len(self.data),
+            'cache.size': self._cache_size(probed),
             'cache.holes': holes,
             'cache.overlaps': overlaps,
-            # The cache end is the max end of any interval
-            'cache.end': sorted(intervals, key=lambda tup: tup[1])[-1][1],
+            'cache.end': cache_end,
+            'cache.runway': self._runway(future, now),
             'cache.timestamp': self.cache_timestamp,
+            'refresh.timings': self.meta.get('timings', {}),
+            'breaker.open': self.breaker.is_open,
+            'coverage.probed': probed,
         }
         return stats
 
     @property
     def runway(self):
         '''Return the the first future hole in the cache or its end.'''
-        intervals = merge_intervals(
-            [(s.start, s.end) for s in self.future_shifts])
-        if intervals[0][0] > self.now:
-            return self.now
+        future, probed = self._future_intervals()
+        return self._runway(future, self.now)
+
+    def _runway(self, future, now):
+        '''Return the first hole after `now` in the `future` intervals.
+
+        The runway is `now` if nobody is on duty (or will ever be).
+        '''
+        if not future:
+            return now
+        if NUMPY_AVAILABLE:
+            cover = Coverage(now, max(end for start, end in future),
+                             self.coverage_slot).add(future)
+            return cover.first_hole()
+        intervals = merge_intervals(future)
+        if intervals[0][0] > now:
+            return now
         return intervals[0][1]
 
     @property
@@ -259,15 +807,40 @@ class Roster(object):
     def future_shifts(self):
         '''Return a generator with all shifts ending any time after "now".'''
         frozen = self.now
+        if self.indexed:
+            rows = self.cache.between(frozen, FAR_FUTURE)
+            return (Shift(*row) for row in rows)
         return (s for s in self.data if s.end > frozen)
 
+    @property
+    def indexed(self):
+        '''True if queries can be answered by the cache backend directly.'''
+        return self.cache.indexed and self._data is None and not self.stale
+
+    @property
+    def meta(self):
+        '''Return the metadata recorded at the last update of the cache.'''
+        return self.cache.read_meta()
+
+    @property
+    def segments(self):
+        '''Return the list of time ranges the cache holds shifts for.'''
+        if self._segments is None:
+            meta = self.meta
+            if 'segments' in meta:
+                pairs = meta['segments']
+            elif 'min_end' in meta:
+                pairs = [(meta['min_end'], meta['max_start'])]
+            else:
+                pairs = []
+            self._segments = [(dtfy(start), dtfy(end) or FAR_FUTURE)
+                              for start, end in pairs]
+        return self._segments
+
     @property
     def cache_timestamp(self):
         '''Return the datetime of the moment the cache was built.'''
-        if not os.path.exists(self.cache_fname):
-            return None
-        mtime = os.path.getmtime(self.cache_fname)
-        return datetime.utcfromtimestamp(mtime).replace(tzinfo=pytz.UTC)
+        return dtfy(self.meta.get('fetched_at'))
 
     @property
     def stale(self):
@@ -275,6 +848,11 @@ class Roster(object):
         if self.cache_timestamp is None:
             return True
         max_delta = timedelta(minutes=self.cache_timeout)
+        # When refreshed by the scheduler, the cache is fresh until the next
+        # planned refresh (with some slack, in case the scheduler is late).
+        next_refresh = dtfy(self.meta.get('next_refresh'))
+        if next_refresh is not None and next_refresh > self.cache_timestamp:
+            return self.now > next_refresh + max_delta
         return (self.now - self.cache_timestamp) > max_delta
 
     @property
@@ -293,10 +871,28 @@ class Roster(object):
         return '\n'.join(
             ('\t'.join(map(unicode, row.as_tuple)) for row in self.data))
 
+    def cached_current(self):
+        '''Return the shifts on duty according to the cache as it is.
+
+        Unlike `current`, this never contacts Google and is safe to call
+        while another thread is using the roster.
+        '''
+        cache = type(self.cache)(self.cache_directory, self.name)
+        try:
+            rows = cache.load()
+        except (IOError, ValueError):
+            log.error('Cannot load cache file "{}"'.format(cache.fname))
+            return []
+        now = self.now
+        shifts = [Shift(*row) for row in rows]
+        return [shift for shift in shifts if shift.start <= now <= shift.end]
+
     @property
     def current(self):
         '''Return *all* shift objects that are currently on duty.'''
         frozen_instant = self.now
+        if self.indexed:
+            return [Shift(*row) for row in self.cache.at(frozen_instant)]
         ret = []
         for shift in self.data:
             if shift.start <= frozen_instant <= shift.end:
@@ -0,0 +1,103 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+'''
+Refresh the cache of a roster when it matters.
+
+Rather than every `cache.timeout` minutes, the cache is refreshed shortly
+before each handover (so that whoever is paged at a handover is looked up on
+fresh data), and - in between handovers - at a pace that depends on how often
+the calendar has been found changed at past refreshes.  Long stretches of a
+stable roster thus cost very few calls to Google.
+
+The rate of change is learned across runs, and stored in the metadata of the
+cache together with the time of the next planned refresh.  The latter tells
+the other googios commands that the cache is kept fresh by the scheduler, and
+does not need refreshing until then.
+'''
+import time
+from datetime import timedelta
+
+from utils import log, dtfy, handovers
+
+# Weight of the last refresh in the learned rate of change of the calendar
+LEARNING_RATE = 0.2
+
+# The rate of change assumed for a roster never refreshed by the scheduler
+INITIAL_CHANGE_RATE = 0.5
+
+
+def refresh(roster):
+    '''Update the cache of `roster`.  Return the updated rate of change.
+
+    Return `None` if the cache could not be updated (e.g.: Google could not
+    be reached).
+    '''
+    before = roster.meta.get('checksum')
+    fetched_at = roster.meta.get('fetched_at')
+    try:
+        roster.update_cache()
+    except SystemExit:  # With no cache to fall back on
+        log.error('Refresh of "{}" aborted'.format(roster.name))
+        return None
+    except Exception as e:
+        msg = 'Refresh of "{}" failed: {}'
+        log.error(msg.format(roster.name, e.__class__.__name__))
+        return None
+    if roster.meta.get('fetched_at') == fetched_at:
+        return None
+    rate = roster.meta.get('change_rate', INITIAL_CHANGE_RATE)
+    changed = roster.meta.get('checksum') != before
+    rate = (1 - LEARNING_RATE) * rate + LEARNING_RATE * changed
+    msg = 'Roster {}changed, rate of change is now {:.2f}'
+    log.debug(msg.format('' if changed else 'un', rate))
+    return rate
+
+
+def next_refresh(roster, rate, lead, min_interval, max_interval):
+    '''Return the moment of the next refresh of `roster`.
+
+    Arguments:
+        rate:         the fraction of refreshes that find a changed calendar.
+        lead:         how long before a handover the cache is refreshed.
+        min_interval: the interval between refreshes for an ever-changing
+                      calendar.
+        max_interval: the interval between refreshes for a calendar that
+                      never changes.
+    '''
+    now = roster.now
+    interval = min_interval.total_seconds() / max(rate, 1e-3)
+    interval = min(timedelta(seconds=interval), max_interval)
+    moment = now + interval
+    # A handover less than `lead` away has just been refreshed for
+    upcoming = handovers(((s.start, s.end) for s in roster.future_shifts),
+                         now + lead)
+    if upcoming:
+        moment = min(moment, upcoming[0] - lead)
+    return moment
+
+
+def schedule(get_roster, lead=10, min_interval=30, max_interval=720):
+    '''Refresh a roster forever, according to its handovers.
+
+    Arguments:
+        get_roster:   a callback returning the roster to refresh (a new roster
+                      at each refresh, so that its time window moves on).
+        lead, min_interval, max_interval: see `next_refresh` (in minutes).
+    '''
+    lead = timedelta(minutes=lead)
+    min_interval = timedelta(minutes=min_interval)
+    max_interval = timedelta(minutes=max_interval)
+    while True:
+        roster = get_roster()
+        log.info('Scheduled refresh of "{}"'.format(roster.name))
+        rate = refresh(roster)
+        if rate is None:
+            log.warning('Scheduled refresh failed, retrying soon.')
+            moment = roster.now + min_interval
+        else:
+            moment = next_refresh(roster, rate, lead, min_interval,
+                                  max_interval)
+            roster.update_meta(change_rate=rate,
+                               next_refresh=dtfy(moment, as_iso_string=True))
+        log.info('Next refresh of "{}" at {}'.format(roster.name, moment))
+        time.sleep(max((moment - roster.now).total_seconds(), 0))
@@ -0,0 +1,238 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+'''
+Persist roster rows in an SQLite database.
+
+A drop-in alternative to `cache.TsvCache`.  Shifts are stored (together with
+the contacts they were retrieved with) indexed on their start and end, so that
+range queries (and the per-day grouping of reports) run in SQL rather than on
+the full list of shifts.  The database runs in WAL mode: any number of readers
+can query it while a writer updates it.
+'''
+import os
+import json
+import sqlite3
+from datetime import datetime
+from collections import Counter
+
+import pytz
+
+from utils import log, dtfy, subtract_intervals, timestamp
+from cache import month_start, checksum
+
+# How long (in seconds) a writer waits for another writer to finish
+LOCK_TIMEOUT = 10
+
+# SQLite limits the number of parameters of a query (999 in older releases)
+MAX_DAYS_PER_QUERY = 300
+
+# Databases with an older schema are dropped (and rebuilt from Google)
+SCHEMA_VERSION = 2
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS shifts (
+    start_ts REAL NOT NULL,
+    end_ts   REAL NOT NULL,
+    start    TEXT NOT NULL,
+    finish   TEXT NOT NULL,
+    name     TEXT NOT NULL,
+    email    TEXT NOT NULL,
+    phone    TEXT NOT NULL,
+    UNIQUE (start, finish, name, email, phone)
+);
+CREATE INDEX IF NOT EXISTS shifts_start ON shifts (start_ts);
+CREATE INDEX IF NOT EXISTS shifts_end ON shifts (end_ts);
+CREATE TABLE IF NOT EXISTS meta (
+    key   TEXT PRIMARY KEY,
+    value TEXT NOT NULL
+);
+'''
+
+SELECT = '''
+SELECT shifts.start, shifts.finish, shifts.name, shifts.email, shifts.phone
+FROM shifts
+'''
+
+OBSOLETE = '''
+DROP TABLE IF EXISTS contacts;
+DROP TABLE IF EXISTS shifts;
+DROP TABLE IF EXISTS meta;
+'''
+
+
+class SqliteCache(object):
+
+    '''An SQLite database with the rows of a roster.
+
+    Rows are tuples of unicode strings, with an empty string for missing
+    values, exactly as for `TsvCache`.
+
+    Arguments:
+        directory : the directory where the database is stored
+        name      : the name of the roster
+    '''
+
+    indexed = True
+
+    def __init__(self, directory, name):
+        self.fname = os.path.realpath(
+            os.path.join(directory, name + '.sqlite'))
+        self.hot_start = month_start(datetime.now(tz=pytz.UTC))
+        self.corrupted = []  # Never populated: SQLite is transactional
+        self._connection = None
+        self._loaded = []  # The ranges of rows loaded so far
+        self._rows = None  # The rows as last read from/written to disk
+        self._meta = None
+
+    @property
+    def connection(self):
+        '''Return the connection to the database, creating it if needed.'''
+        if self._connection is None:
+            self._connection = sqlite3.connect(self.fname,
+                                               timeout=LOCK_TIMEOUT)
+            self._connection.execute('PRAGMA journal_mode=WAL')
+            version = self._connection.execute(
+                'PRAGMA user_version').fetchone()[0]
+            if version < SCHEMA_VERSION:
+                tables = self._connection.execute(
+                    "SELECT COUNT(*) FROM sqlite_master WHERE type = 'table'")
+                if tables.fetchone()[0]:
+                    log.info('Obsolete cache database, it will be rebuilt')
+                    self._connection.executescript(OBSOLETE)
+                self._connection.execute(
+                    'PRAGMA user_version = {}'.format(SCHEMA_VERSION))
+            self._connection.executescript(SCHEMA)
+        return self._connection
+
+    def _select(self, where='', args=()):
+        '''Return the rows matching the `where` SQL clause.'''
+        query = SELECT + where + ' ORDER BY shifts.start_ts, shifts.end_ts'
+        return [tuple(row) for row in self.connection.execute(query, args)]
+
+    def load(self):
+        '''Return the rows of the shifts ending in the current month or later.
+
+        Unlike for the TSV cache, an empty database is not an error.
+        '''
+        rows = self._select('WHERE shifts.end_ts >= ?',
+                            (timestamp(self.hot_start), ))
+        self._loaded = [(self.hot_start, None)]
+        self._rows = Counter(rows)
+        return rows
+
+    @property
+    def checksum(self):
+        '''Return the checksum of the rows last read from/written to disk.'''
+        return checksum(self._rows)
+
+    def load_range(self, start, end):
+        '''Return the rows overlapping `start`-`end` not loaded so far.'''
+        end = min(end, self.hot_start)
+        if start >= end:
+            return []
+        rows = set()
+        loaded = [(s, e or end) for s, e in self._loaded]
+        for gap_start, gap_end in subtract_intervals(start, end, loaded):
+            rows.update(self.between(gap_start, gap_end))
+            self._loaded.append((gap_start, gap_end))
+        # Shifts across the boundary of a loaded range have been seen already
+        rows = [row for row in rows if not self._rows[row]]
+        self._rows.update(rows)
+        return rows
+
+    def between(self, start, end):
+        '''Return the rows of the shifts overlapping `start`-`end`.'''
+        return self._select('WHERE shifts.end_ts > ? AND shifts.start_ts < ?',
+                            (timestamp(start), timestamp(end)))
+
+    def fingerprint(self, start, end):
+        '''Return the checksum of the rows overlapping `start`-`end`.'''
+        return checksum(Counter(self.between(start, end)))
+
+    def at(self, moment):
+        '''Return the rows of the shifts in progress at `moment`.'''
+        moment = timestamp(moment)
+        return self._select(
+            'WHERE shifts.start_ts <= ? AND shifts.end_ts >= ?',
+            (moment, moment))
+
+    def count(self):
+        '''Return the number of shifts ending in the current month or later.'''
+        query = 'SELECT COUNT(*) FROM shifts WHERE end_ts >= ?'
+        args = (timestamp(self.hot_start), )
+        return self.connection.execute(query, args).fetchone()[0]
+
+    def names_by_day(self, days):
+        '''Return the names of the people on duty for each of `days`.
+
+        Arguments:
+            days: a list of (start, end) datetimes.
+        '''
+        names = []
+        for index in range(0, len(days), MAX_DAYS_PER_QUERY):
+            names.extend(
+                self._names_by_day(days[index:index + MAX_DAYS_PER_QUERY]))
+        return names
+
+    def _names_by_day(self, days):
+        '''Run the query behind `names_by_day` for a chunk of `days`.'''
+        values = ', '.join(['(?, ?, ?)'] * len(days))
+        args = []
+        for counter, (start, end) in enumerate(days):
+            args.extend((counter, timestamp(start), timestamp(end)))
+        query = '''
+            WITH days (day, start_ts, end_ts) AS (VALUES {})
+            SELECT days.day, shifts.name
+            FROM days JOIN shifts
+                ON shifts.end_ts > days.start_ts
+                AND shifts.start_ts < days.end_ts
+            ORDER BY days.day, shifts.start_ts, shifts.end_ts
+        '''.format(values)
+        names = [[] for day in days]
+        for day, name in self.connection.execute(query, args):
+            names[day].append(name.encode('utf-8'))
+        return names
+
+    def save(self, rows):
+        '''Store `rows`, writing only what changed.  Return True on change.
+
+        Shifts outside the ranges loaded so far are not removed.  Identical
+        shifts are stored only once.
+        '''
+        if self._rows is None:
+            self.load()
+        new = Counter(set(rows))
+        added = new - self._rows
+        removed = self._rows - new
+        if not added and not removed:
+            log.debug('Cache content unchanged, skipping write')
+            return False
+        log.debug('Writing {} changed cache rows'.format(
+            sum(added.values()) + sum(removed.values())))
+        with self.connection:
+            self.connection.executemany(
+                'DELETE FROM shifts WHERE start = ? AND finish = ? '
+                'AND name = ? AND email = ? AND phone = ?', removed)
+            self.connection.executemany(
+                'INSERT OR REPLACE INTO shifts VALUES (?, ?, ?, ?, ?, ?, ?)',
+                [(timestamp(dtfy(row[0])), timestamp(dtfy(row[1]))) + row
+                 for row in added])
+        self._rows = new
+        return True
+
+    def read_meta(self):
+        '''Return the metadata of the cache (read from disk only once).'''
+        if self._meta is None:
+            query = "SELECT value FROM meta WHERE key = 'meta'"
+            row = self.connection.execute(query).fetchone()
+            self._meta = {} if row is None else json.loads(row[0])
+        return self._meta
+
+    def write_meta(self, meta):
+        '''Store `meta`, completed with the checksum of the cached rows.'''
+        meta = dict(meta, checksum=self.checksum)
+        with self.connection:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO meta VALUES ('meta', ?)",
+                (json.dumps(meta, sort_keys=True), ))
+        self._meta = meta
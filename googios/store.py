@@ -0,0 +1,153 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+'''
+Serve roster lookups to multi-threaded applications.
+
+`Roster` objects load and refresh their data lazily and are not meant to be
+shared among threads.  A `RosterStore` keeps instead an immutable `Snapshot`
+of each roster it manages: readers look shifts up in the snapshot they get,
+without any locking, while refreshes build a brand new snapshot and swap it in
+with a single assignment.
+
+Example:
+
+    store = RosterStore()
+    store.add('dev', partial(get_roster, load_config('dev')))
+    store.start(interval=60)
+    ...
+    store.current('dev')  # From any thread, as often as needed
+'''
+import bisect
+import threading
+from datetime import datetime
+
+import pytz
+
+from utils import log
+
+
+class Snapshot(object):
+
+    '''An immutable view of the shifts of a roster.
+
+    Arguments:
+        name     : the name of the roster
+        shifts   : the shifts of the roster
+        taken_at : the moment the snapshot was taken
+    '''
+
+    __slots__ = ('name', 'shifts', 'taken_at', '_starts', '_max_ends')
+
+    def __init__(self, name, shifts, taken_at):
+        shifts = tuple(sorted(shifts, key=lambda shift: shift.as_tuple[:2]))
+        max_ends = []
+        for shift in shifts:
+            max_ends.append(max(max_ends[-1], shift.end) if max_ends
+                            else shift.end)
+        for attr, value in (('name', name), ('shifts', shifts),
+                            ('taken_at', taken_at),
+                            ('_starts', tuple(s.start for s in shifts)),
+                            ('_max_ends', tuple(max_ends))):
+            object.__setattr__(self, attr, value)
+
+    def __setattr__(self, attr, value):
+        raise AttributeError('Snapshot objects are immutable')
+
+    def __len__(self):
+        return len(self.shifts)
+
+    def at(self, moment):
+        '''Return the shifts in progress at `moment` (start <= moment < end).'''
+        ret = []
+        index = bisect.bisect_right(self._starts, moment)
+        # Walk back while some earlier shift may still be in progress
+        while index > 0 and self._max_ends[index - 1] > moment:
+            index -= 1
+            if self.shifts[index].end > moment:
+                ret.append(self.shifts[index])
+        return ret[::-1]
+
+    def between(self, start, end):
+        '''Return the shifts overlapping the range `start`-`end`.'''
+        index = bisect.bisect_left(self._starts, end)
+        return [shift for shift in self.shifts[:index] if shift.end > start]
+
+
+class RosterStore(object):
+
+    '''A thread-safe collection of roster snapshots.
+
+    Rosters are added with a callback returning a new `Roster` object: every
+    refresh works on a new roster (so that its time window moves on with time)
+    that is never seen by the readers.
+    '''
+
+    def __init__(self):
+        self._factories = {}
+        self._snapshots = {}
+        self._lock = threading.Lock()  # Only one refresh at a time
+        self._stop = threading.Event()
+        self._thread = None
+
+    def add(self, name, get_roster):
+        '''Add a roster to the store, and take its first snapshot.'''
+        self._factories[name] = get_roster
+        self.refresh(name, force=False)
+
+    def refresh(self, name, force=True):
+        '''Take a new snapshot of the roster `name`.
+
+        Unless forced, the roster cache is only updated if stale.  If the
+        roster cannot be loaded, the previous snapshot is kept.
+        '''
+        with self._lock:
+            try:
+                roster = self._factories[name]()
+                if force:
+                    roster.update_cache()
+                shifts = roster.data  # Updates the cache if stale
+            except (Exception, SystemExit) as e:
+                msg = 'Cannot refresh roster "{}" ({}), keeping old snapshot'
+                log.error(msg.format(name, e.__class__.__name__))
+                return self._snapshots.get(name)
+            snapshot = Snapshot(name, shifts, datetime.now(tz=pytz.UTC))
+            # The swap is atomic: readers get either the old or new snapshot
+            self._snapshots[name] = snapshot
+            log.debug('New snapshot of "{}" ({} shifts)'.format(
+                name, len(snapshot)))
+            return snapshot
+
+    def snapshot(self, name):
+        '''Return the latest snapshot of the roster `name`.'''
+        try:
+            return self._snapshots[name]
+        except KeyError:
+            raise KeyError('No snapshot of roster "{}"'.format(name))
+
+    def current(self, name, moment=None):
+        '''Return the shifts of roster `name` in progress at `moment` (now).'''
+        return self.snapshot(name).at(moment or datetime.now(tz=pytz.UTC))
+
+    def start(self, interval=60):
+        '''Refresh the stale rosters every `interval` seconds, in background.'''
+        if self._thread is not None:
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, args=(interval, ),
+                                        name='roster-store-refresher')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        '''Stop the background refresher.'''
+        if self._thread is None:
+            return
+        self._stop.set()
+        self._thread.join()
+        self._thread = None
+
+    def _run(self, interval):
+        '''Body of the background refresher.'''
+        while not self._stop.wait(interval):
+            for name in list(self._factories):
+                self.refresh(name, force=False)
@@ -0,0 +1,383 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+'''
+Stress the cache of a roster as an alert storm would.
+
+Usage:
+    googios-stress [options]
+
+Options:
+    -h --help             Show this screen.
+    --readers=<n>         Concurrent `current` lookups [default: 50].
+    --writers=<m>         Concurrent forced `update`s [default: 1].
+    --queriers=<q>        Concurrent `query`s of ranges past the window
+                          [default: 2].
+    --duration=<s>        Seconds the test lasts [default: 10].
+    --latency=<ms>        Average latency of the fake Google [default: 200].
+    --failures=<rate>     Fraction of failing calls to Google [default: 0].
+    --timeout=<s>         Seconds before the cache goes stale [default: 5].
+    --pause=<ms>          Pause of readers between lookups [default: 0].
+    --corrupt=<rate>      Fraction of updates finding the cache corrupted
+                          [default: 0].
+    --backend=<backend>   The cache backend, tsv or sqlite [default: tsv].
+    --directory=<dir>     Directory for the cache [default: a temporary one].
+    -e --echo             Log to stderr (very verbose).
+
+Each reader, writer and querier is a separate process, exactly like the
+`googios` invocations of Nagios, cron and users.  Readers look up who is on
+duty, refreshing the cache if stale; writers force an update of the cache,
+then wait a cache timeout.  Google is replaced by a fake whose calendar
+changes at every call, with random latency and failures.  Before an update,
+writers may corrupt the cache, as a crash or a faulty disk would: the update
+must then rebuild it.
+The roster also holds a week of shifts filled in before the window of the
+updates, that must survive them.  Queriers look up a few random days after
+the window, filling them in from Google when not in the cache yet (their
+results are "partial" if Google fails).
+
+Every generation of the fake calendar has its own handovers and names, so
+that a reader seeing shifts of different generations (or not exactly one
+shift on duty) has read a cache that was being written: a "torn read".
+Refreshes overlapping in time are "duplicate refreshes", lookups exiting with
+`EX_IOERR` could not find any data, and filled shifts (or days queried)
+missing at the end have been lost by an update (days queried may only be
+dropped, as a whole, with a corrupted cache).  A query returning a range
+with holes, though the cache claims to hold it, is a torn read too.  The exit
+status is non-zero if any of these happened.
+'''
+import os
+import sys
+import time
+import random
+import shutil
+import logging
+import tempfile
+import sqlite3
+import multiprocessing
+from datetime import datetime, timedelta
+from collections import Counter
+
+import pytz
+from docopt import docopt
+
+from utils import timestamp, subtract_intervals
+from cache import month_start, atomic_write
+from roster import Roster, Shift
+
+# The span of the fake roster, from the beginning of the month
+ROSTER_DAYS = 60
+
+# The length of a shift of the fake roster, in hours
+SHIFT_HOURS = 8
+
+PERCENTILES = (50, 90, 99, 100)
+
+
+class FakeCalendar(object):
+
+    '''What `Roster.update_cache` reads from a calendar after a listing.'''
+
+    sync_token = None
+    etag = None
+
+
+class FakeRoster(Roster):
+
+    '''A roster whose calendar is a fake Google, changing at every call.
+
+    Arguments:
+        google   : the `(generation, refreshes)` shared by all processes
+        role     : the role of the process ('reader' or 'writer')
+        latency  : the average latency of the calls, in seconds
+        failures : the fraction of calls failing
+        base     : the beginning of the roster
+    '''
+
+    def __init__(self, google, role, latency, failures, base, **kwargs):
+        Roster.__init__(self, 'stress', 'fake', None, None,
+                        min_end=base.isoformat(),
+                        max_start=(base + timedelta(days=ROSTER_DAYS)
+                                   ).isoformat(), **kwargs)
+        self.generation, self.refreshes = google
+        self.role = role
+        self.latency = latency
+        self.failures = failures
+        self.base = base
+
+    def _retrieve_live(self, start=None, end=None, etag=None):
+        started = time.time()
+        if self.latency:
+            time.sleep(random.expovariate(1.0 / self.latency))
+        if random.random() < self.failures:
+            self.refreshes.append((self.role, started, time.time(), False))
+            raise IOError('Injected failure')
+        with self.generation.get_lock():
+            self.generation.value += 1
+            generation = self.generation.value
+        self.calendar = FakeCalendar()
+        self.refreshes.append((self.role, started, time.time(), True))
+        if start is None:
+            return rotation(generation, self.base)
+        return rotation(generation, start, end)
+
+
+def rotation(generation, base, end=None):
+    '''Return the shifts of a generation of the fake calendar.
+
+    With an `end`, return the shifts of a range filled in by a query: they
+    hand over at fixed times (every `SHIFT_HOURS` from 1 AM), so that ranges
+    filled in at different generations fit together.
+    '''
+    if end is None:
+        # Each generation hands over at a different time (never at `base`,
+        # where a shift would not belong to the window beginning there)
+        start = base - timedelta(hours=generation % (SHIFT_HOURS - 1) + 1)
+        end = base + timedelta(days=ROSTER_DAYS)
+    else:
+        # The ranges begin at midnight
+        start = base - timedelta(hours=SHIFT_HOURS - 1)
+    shifts = []
+    counter = 0
+    while start < end:
+        stop = start + timedelta(hours=SHIFT_HOURS)
+        name = u'g{}-p{}'.format(generation, counter % 5)
+        shifts.append(Shift(start, stop, name, name + u'@example.com',
+                            u'+{}'.format(counter)))
+        start = stop
+        counter += 1
+    return shifts
+
+
+def lookup(roster):
+    '''Return the outcome of a lookup of the person on duty.'''
+    try:
+        data = roster.data
+    except SystemExit as e:
+        return 'exit {}'.format(e.code)
+    except Exception as e:
+        return e.__class__.__name__
+    now = roster.now
+    on_duty = [shift for shift in data if shift.start <= now < shift.end]
+    # Shifts outside the window of the updates are from other generations
+    window_end = roster.base + timedelta(days=ROSTER_DAYS)
+    generations = set(shift.name.split('-')[0] for shift in data
+                      if shift.end > now and shift.start < window_end)
+    if len(on_duty) != 1 or len(generations) != 1:
+        return 'torn read'
+    return 'ok'
+
+
+def span(roster):
+    '''Return a random range of days after the window of the updates.'''
+    start = roster.base + timedelta(days=ROSTER_DAYS + 1 +
+                                    random.randint(0, ROSTER_DAYS))
+    return start, start + timedelta(days=random.randint(1, 3))
+
+
+def complete(roster, start, end, shifts):
+    '''True if the cache holds `start`-`end`, and `shifts` span it.'''
+    if not roster.covers(start, end):
+        return False
+    return not subtract_intervals(
+        start, end, [(shift.start, shift.end) for shift in shifts])
+
+
+def query(roster, start, end, queried):
+    '''Return the outcome of a query of `start`-`end`.
+
+    Complete queries are added to `queried`, to be checked at the end.
+    '''
+    try:
+        shifts = roster.query(start, end)
+    except SystemExit as e:
+        return 'exit {}'.format(e.code)
+    except Exception as e:
+        return e.__class__.__name__
+    if not roster.covers(start, end):
+        return 'partial'  # Google could not be reached
+    if not complete(roster, start, end, shifts):
+        return 'torn read'
+    queried.append((start, end))
+    return 'ok'
+
+
+def corrupt(roster):
+    '''Corrupt the hot segment of the cache, so that it cannot be loaded.'''
+    cache = roster.cache
+    if cache.indexed:
+        connection = sqlite3.connect(cache.fname)
+        with connection:
+            connection.execute('DELETE FROM shifts WHERE end_ts >= ?',
+                               (timestamp(cache.hot_start), ))
+        connection.close()
+    else:
+        with open(cache.fname, 'rb') as file_:
+            lines = file_.read().splitlines(True)
+        # The checksum in the metadata no longer matches
+        atomic_write(cache.fname, ''.join(lines[1:]))
+
+
+def update(roster, corruption):
+    '''Update the cache of `roster`, first corrupting it if `corruption`.'''
+    if not corruption:
+        roster.update_cache()
+        return
+    # As if the previous update crashed while writing the cache: the cache
+    # is rebuilt before the lock is released, even if Google fails at first
+    # (with SQLite, rows missing from the cache are only noticed on loading)
+    with roster._refresh_lock():
+        corrupt(roster)
+        while True:
+            try:
+                roster.update_cache()
+                return
+            except SystemExit:
+                roster._reopen_cache()
+
+
+def work(role, google, results, options, base, queried):
+    '''Body of a reader, writer or querier process.'''
+    random.seed()
+    deadline = time.time() + float(options['--duration'])
+    timeout = float(options['--timeout'])
+    pause = float(options['--pause']) / 1000
+    corruption = float(options['--corrupt'])
+    samples = []
+    while time.time() < deadline:
+        roster = FakeRoster(
+            google, role, float(options['--latency']) / 1000,
+            float(options['--failures']), base,
+            cache_timeout=timeout / 60, cache_directory=options['--directory'],
+            cache_backend=options['--backend'])
+        started = time.time()
+        if role == 'writer':
+            try:
+                update(roster, random.random() < corruption)
+                outcome = 'ok'
+            except SystemExit as e:
+                outcome = 'exit {}'.format(e.code)
+            except Exception as e:
+                outcome = e.__class__.__name__
+        elif role == 'querier':
+            outcome = query(roster, *span(roster), queried=queried)
+        else:
+            outcome = lookup(roster)
+        samples.append((time.time() - started, outcome))
+        time.sleep(timeout if role == 'writer' else pause)
+    results.put((role, samples))
+
+
+def percentiles(values):
+    '''Return the `PERCENTILES` of `values`.'''
+    values = sorted(values)
+    return [values[min(int(len(values) * p / 100.0), len(values) - 1)]
+            for p in PERCENTILES]
+
+
+def overlapping(refreshes):
+    '''Return the number of refreshes starting before the previous ended.'''
+    count = 0
+    last_end = None
+    for role, start, end, success in sorted(refreshes,
+                                            key=lambda item: item[1]):
+        if last_end is not None and start < last_end:
+            count += 1
+        last_end = end if last_end is None else max(last_end, end)
+    return count
+
+
+def run(options):
+    '''Run the stress test.  Return True if no problem was found.'''
+    base = month_start(datetime.now(tz=pytz.UTC))
+    manager = multiprocessing.Manager()
+    google = (multiprocessing.Value('i', 0), manager.list())
+    results = multiprocessing.Queue()
+    # Start from a fresh cache, like a roster updated by cron, with a week
+    # of shifts before its window
+    roster = FakeRoster(google, 'setup', 0, 0, base,
+                        cache_directory=options['--directory'],
+                        cache_backend=options['--backend'])
+    roster.update_cache()
+    roster.fill(base - timedelta(days=7), base)
+    roster.update_cache()
+    filled = len(roster.query(base - timedelta(days=7), base))
+    del google[1][:]
+    queried = manager.list()
+    processes = []
+    for role, count in (('writer', options['--writers']),
+                        ('reader', options['--readers']),
+                        ('querier', options['--queriers'])):
+        for counter in range(int(count)):
+            process = multiprocessing.Process(
+                target=work,
+                args=(role, google, results, options, base, queried))
+            process.start()
+            processes.append(process)
+    samples = {'reader': [], 'writer': [], 'querier': []}
+    for process in processes:
+        role, items = results.get()
+        samples[role].extend(items)
+    for process in processes:
+        process.join()
+    refreshes = list(google[1])
+    problems = 0
+    # The filled shifts must have survived the updates
+    roster = FakeRoster(google, 'check', 0, 0, base,
+                        cache_timeout=10 ** 6,  # Never stale
+                        cache_directory=options['--directory'],
+                        cache_backend=options['--backend'])
+    lost = filled - len(roster.query(base - timedelta(days=7), base))
+    # So must the days queried, unless forgotten with a corrupted cache (but
+    # never claimed by the cache without their shifts)
+    forgotten = 0
+    for start, end in queried:
+        if roster.covers(start, end):
+            forgotten += not complete(roster, start, end,
+                                      roster.query(start, end))
+        else:
+            forgotten += not float(options['--corrupt'])
+    print('\n          C A C H E   S T R E S S   T E S T')
+    print('=====================================================\n')
+    for role in ('reader', 'writer', 'querier'):
+        if not samples[role]:
+            continue
+        latencies = [latency * 1000 for latency, outcome in samples[role]]
+        outcomes = Counter(outcome for latency, outcome in samples[role])
+        print('  {}s: {} operations'.format(role.capitalize(),
+                                           len(latencies)))
+        print('    Latency (ms)  p50 {:.1f}  p90 {:.1f}  p99 {:.1f}  '
+              'max {:.1f}'.format(*percentiles(latencies)))
+        for outcome, count in sorted(outcomes.items()):
+            print('    {:<24}{:>8}'.format(outcome, count))
+        problems += sum(count for outcome, count in outcomes.items()
+                        if outcome not in ('ok', 'partial'))
+    by_role = Counter(role for role, start, end, success in refreshes)
+    duplicates = overlapping(refreshes)
+    print('\n  Calls to Google')
+    for role, count in sorted(by_role.items()):
+        print('    {:<24}{:>8}'.format('by ' + role + 's', count))
+    print('    {:<24}{:>8}'.format('failed', sum(
+        1 for role, start, end, success in refreshes if not success)))
+    print('    {:<24}{:>8}'.format('duplicate', duplicates))
+    print('\n  Filled shifts lost        {:>8}'.format(lost))
+    print('  Queried ranges lost       {:>8}\n'.format(forgotten))
+    return problems == 0 and duplicates == 0 and lost == 0 and forgotten == 0
+
+
+def main():
+    options = docopt(__doc__)
+    if not options['--echo']:
+        logging.disable(logging.CRITICAL)
+    temporary = options['--directory'] == 'a temporary one'
+    if temporary:
+        options['--directory'] = tempfile.mkdtemp(prefix='googios-stress-')
+    try:
+        success = run(options)
+    finally:
+        if temporary:
+            shutil.rmtree(options['--directory'])
+    sys.exit(os.EX_OK if success else os.EX_SOFTWARE)
+
+
+if __name__ == '__main__':
+    main()
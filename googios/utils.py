@@ -3,7 +3,9 @@
 import os
 import json
 import logging
+import calendar
 import datetime
+import threading
 from collections import namedtuple
 from itertools import takewhile
 
@@ -41,9 +43,17 @@ log = logging.getLogger('googios')
 log.addHandler(log_stream_handler)
 log.setLevel(ON_SCREEN_LOGGING_LEVEL)
 
-# Store cached values of the service/client once initialised
-__cal_service = None
-__ppl_client = None
+# Used as the end of intervals that are open into the future
+FAR_FUTURE = datetime.datetime.max.replace(tzinfo=pytz.UTC)
+
+# Store cached values of the service/client once initialised, by directory of
+# the credentials (rosters may use different ones).  Their HTTP connections
+# are not thread-safe: each thread (e.g.: the lookups of an escalation chain)
+# has its own.
+__clients = threading.local()
+
+# Beginnings of the days, by (time zone, offset, year, month), see `day_starts`
+__day_starts = {}
 
 
 class TwoLeggedOauth(object):
@@ -133,27 +143,36 @@ class ThreeLeggedOauth(object):
 
 def get_people_client(oauth_dir=''):
     '''Ruturn a client for the contacts API.'''
-    global __ppl_client
     oauth_fname = os.path.join(oauth_dir, '3-legged.oauth')
-    if __ppl_client is None:
+    ppl_clients = _thread_clients('people')
+    if oauth_dir not in ppl_clients:
         log.debug('Generating "contacts" client...')
         credentials = ThreeLeggedOauth.get_credentials(oauth_fname)
         if credentials.invalid:
             log.critical('Invalid 3-legged credentials')
             exit(os.EX_CONFIG)
-        __ppl_client = ThreeLeggedOauth.get_contacts_client(credentials)
-    return __ppl_client
+        ppl_clients[oauth_dir] = ThreeLeggedOauth.get_contacts_client(
+            credentials)
+    return ppl_clients[oauth_dir]
 
 
 def get_calendar_service(oauth_dir=''):
     '''Ruturn a service for the calendar API.'''
-    global __cal_service
     oauth_fname = os.path.join(oauth_dir, '2-legged.oauth')
-    if __cal_service is None:
+    cal_services = _thread_clients('calendar')
+    if oauth_dir not in cal_services:
         log.debug('Generating the "calendar" service...')
         http_auth = TwoLeggedOauth.get_http_auth(oauth_fname)
-        __cal_service = TwoLeggedOauth.get_service('calendar', 'v3', http_auth)
-    return __cal_service
+        cal_services[oauth_dir] = TwoLeggedOauth.get_service(
+            'calendar', 'v3', http_auth)
+    return cal_services[oauth_dir]
+
+
+def _thread_clients(kind):
+    '''Return the clients of `kind` of the current thread, by directory.'''
+    if not hasattr(__clients, kind):
+        setattr(__clients, kind, {})
+    return getattr(__clients, kind)
 
 
 def dtfy(something, tz=None, as_iso_string=False):  # tdfy = datetime-fy
@@ -177,6 +196,11 @@ def dtfy(something, tz=None, as_iso_string=False):  # tdfy = datetime-fy
     return something
 
 
+def timestamp(moment):
+    '''Return the POSIX timestamp of an aware datetime.'''
+    return calendar.timegm(moment.utctimetuple()) + moment.microsecond / 1e6
+
+
 def plus_one_day(aware_dtime):
     '''Compute the datetime of the following day accounting for DTS.'''
     tz = aware_dtime.tzinfo
@@ -185,6 +209,44 @@ def plus_one_day(aware_dtime):
     return tz.normalize(plus_day)  # to detect non-existent times
 
 
+def day_starts(time_zone, first, last, offset=0):
+    '''Return the (aware) beginnings of the days from `first` to `last`.
+
+    The list includes the beginning of the day after `last`, so that day N
+    spans from element N to element N + 1.  Days begin at local midnight plus
+    `offset` hours.  The beginnings are computed once per time zone, offset
+    and month, so that DST is accounted for only once, rather than at every
+    lookup.
+
+    Arguments:
+        time_zone: the name of the time zone
+        first, last: dates
+    '''
+    starts = []
+    month = first.replace(day=1)
+    after_last = last + datetime.timedelta(days=1)
+    while month <= after_last:
+        starts.extend(_month_day_starts(time_zone, offset, month))
+        month = (month + datetime.timedelta(days=32)).replace(day=1)
+    skip = first.day - 1
+    return starts[skip:skip + (last - first).days + 2]
+
+
+def _month_day_starts(time_zone, offset, month):
+    '''Return the beginnings of the days of `month` (see `day_starts`).'''
+    key = (time_zone, offset, month.year, month.month)
+    if key not in __day_starts:
+        tz = pytz.timezone(time_zone)
+        wall = datetime.datetime(month.year, month.month, 1) + \
+            datetime.timedelta(hours=offset)
+        starts = []
+        while (wall - datetime.timedelta(hours=offset)).month == month.month:
+            starts.append(tz.localize(wall))
+            wall += datetime.timedelta(days=1)
+        __day_starts[key] = starts
+    return __day_starts[key]
+
+
 def merge_intervals(intervals):
     '''Given a series intervals merge together the overlapping ones.'''
     sorted_intervals = sorted(intervals)
@@ -218,3 +280,29 @@ def find_overlaps(intervals):
             break
         analysed = sorted_intervals.pop(0)
     return merge_intervals(overlaps)
+
+
+def subtract_intervals(start, end, intervals):
+    '''Return the parts of the interval `start`-`end` not in `intervals`.'''
+    gaps = []
+    for i_start, i_end in merge_intervals(intervals):
+        if i_end <= start:
+            continue
+        if i_start >= end:
+            break
+        if i_start > start:
+            gaps.append((start, i_start))
+        start = i_end
+        if start >= end:
+            break
+    if start < end:
+        gaps.append((start, end))
+    return gaps
+
+
+def handovers(intervals, after):
+    '''Return the sorted moments after `after` where intervals start or end.'''
+    moments = set()
+    for i_start, i_end in intervals:
+        moments.update((i_start, i_end))
+    return sorted(moment for moment in moments if moment > after)
@@ -0,0 +1,313 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+'''
+Refresh the cache of rosters as soon as their calendar changes.
+
+Rather than polling Google every `cache.timeout` minutes, a "watch" channel is
+opened on the calendar of each roster: Google then POSTs a notification to
+`watch.address` whenever its events change.  A small HTTP receiver (listening
+on `watch.port`, behind whatever makes it reachable at `watch.address`) takes
+the notifications, and refreshes only the roster whose calendar changed.
+
+A refresh lists the window of the roster again, rather than only the events
+changed since the sync token of the last listing: such a listing cannot be
+limited to the window, and reports deleted events by id only, while the
+cache holds shifts (with their contacts) and not events.
+
+Channels expire after `watch.ttl` minutes, and are replaced by new ones
+shortly before that.  As notifications are not guaranteed to be delivered,
+rosters are also refreshed every `schedule.max_interval` minutes, and until
+then the other googios commands consider their cache fresh (exactly as with
+the scheduler).
+
+`ping` sends a notification like Google's to a receiver, for testing.
+'''
+import os
+import json
+import time
+import uuid
+import Queue
+import urllib2
+import threading
+from datetime import datetime, timedelta
+from collections import namedtuple
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+
+import pytz
+
+from utils import log, dtfy
+from cache import atomic_write
+from scheduler import refresh
+
+# How long before its expiration a channel is replaced by a new one
+RENEWAL_LEAD = timedelta(hours=1)
+
+# How long to wait before trying again a failed refresh or channel renewal
+RETRY_INTERVAL = timedelta(minutes=5)
+
+# Notifications arriving within this many seconds are served by one refresh
+DEBOUNCE = 2
+
+Channel = namedtuple('Channel', 'id resource_id token expiration')
+
+
+def open_channel(service, cid, address, ttl):
+    '''Open a channel notifying the changes to calendar `cid` at `address`.
+
+    Arguments:
+        ttl: the requested life of the channel, in minutes (Google may
+             shorten it).
+    '''
+    body = {
+        'id': str(uuid.uuid4()),
+        'type': 'web_hook',
+        'address': address,
+        'token': uuid.uuid4().hex,
+        'params': {'ttl': str(ttl * 60)},
+    }
+    data = service.events().watch(calendarId=cid, body=body).execute()
+    expiration = datetime.fromtimestamp(int(data['expiration']) / 1000.0,
+                                        tz=pytz.UTC)
+    return Channel(data['id'], data['resourceId'], body['token'], expiration)
+
+
+def close_channel(service, channel):
+    '''Stop the notifications of `channel`.'''
+    body = {'id': channel.id, 'resourceId': channel.resource_id}
+    service.channels().stop(body=body).execute()
+
+
+def ping(url, channel, state='exists', number=1):
+    '''Send a notification for `channel` to `url`, as Google would.
+
+    Return the HTTP status of the response.
+    '''
+    headers = {
+        'X-Goog-Channel-ID': channel.id,
+        'X-Goog-Channel-Token': channel.token,
+        'X-Goog-Channel-Expiration': channel.expiration.strftime(
+            '%a, %d %b %Y %H:%M:%S GMT'),
+        'X-Goog-Resource-ID': channel.resource_id,
+        'X-Goog-Resource-State': state,
+        'X-Goog-Message-Number': str(number),
+    }
+    request = urllib2.Request(url, data='', headers=headers)
+    try:
+        return urllib2.urlopen(request, timeout=10).getcode()
+    except urllib2.HTTPError as e:
+        return e.code
+
+
+class ChannelFile(object):
+
+    '''The channel open on the calendar of a roster, as stored on disk.
+
+    Arguments:
+        directory : the directory where the cache of the roster is stored
+        name      : the name of the roster
+    '''
+
+    def __init__(self, directory, name):
+        self.fname = os.path.realpath(
+            os.path.join(directory, name + '.channel'))
+
+    def read(self):
+        '''Return the stored `Channel`, or None.'''
+        try:
+            with open(self.fname) as file_:
+                data = json.load(file_)
+        except (IOError, ValueError):
+            return None
+        return Channel(data['id'], data['resource_id'], data['token'],
+                       dtfy(data['expiration']))
+
+    def write(self, channel):
+        '''Store `channel`.'''
+        data = dict(channel._asdict(),
+                    expiration=dtfy(channel.expiration, as_iso_string=True))
+        try:
+            atomic_write(self.fname, json.dumps(data, sort_keys=True))
+        except (IOError, OSError) as e:
+            log.error('Cannot store the channel: {}'.format(e.strerror))
+
+    def remove(self):
+        '''Forget the stored channel.'''
+        try:
+            os.remove(self.fname)
+        except OSError:
+            pass
+
+
+class _Handler(BaseHTTPRequestHandler):
+
+    '''Pass the notifications received to the watcher of the server.'''
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        self.rfile.read(length)  # Notifications of calendars have no body
+        self.send_response(self.server.watcher.notify(self.headers))
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        log.debug('Receiver: ' + format % args)
+
+
+class Watcher(object):
+
+    '''Keep the caches of several rosters fresh with push notifications.
+
+    Arguments:
+        factories    : a {name: callback returning a new roster} dictionary
+        address      : the (HTTPS) URL Google sends the notifications to
+        port         : the local port the receiver listens on
+        ttl          : the life of a channel, in minutes [Defaults to a week]
+        max_interval : minutes between refreshes of a roster that is not
+                       notified of any change [Defaults to 720]
+    '''
+
+    def __init__(self, factories, address, port, ttl=10080, max_interval=720):
+        self.factories = factories
+        self.address = address
+        self.port = port
+        self.ttl = ttl
+        self.max_interval = timedelta(minutes=max_interval)
+        self.channels = {}  # {name: Channel}
+        self.refresh_at = {}  # {name: moment of the next planned refresh}
+        self.renew_at = {}  # {name: moment of the next channel renewal}
+        self.pings = Queue.Queue()
+        self.server = None
+        self._thread = None
+
+    @property
+    def now(self):
+        '''Return the datetime of now.'''
+        return datetime.now(tz=pytz.UTC)
+
+    def notify(self, headers):
+        '''Handle a notification (given its HTTP headers).
+
+        Return the HTTP status to answer with.
+        '''
+        channel_id = headers.get('X-Goog-Channel-ID')
+        for name, channel in self.channels.items():
+            if channel.id == channel_id:
+                break
+        else:
+            log.warning('Notification for unknown channel "{}"'.format(
+                channel_id))
+            return 404
+        if headers.get('X-Goog-Channel-Token') != channel.token:
+            log.warning('Notification with a wrong token for "{}"'.format(
+                name))
+            return 403
+        state = headers.get('X-Goog-Resource-State')
+        if state == 'sync':  # Sent once, when the channel is opened
+            log.debug('Channel for "{}" is open'.format(name))
+        else:
+            log.info('Calendar of "{}" changed ({})'.format(name, state))
+            self.pings.put(name)
+        return 200
+
+    def refresh(self, name):
+        '''Update the cache of roster `name`, and plan its next refresh.'''
+        rate = None
+        try:
+            roster = self.factories[name]()
+            rate = refresh(roster)
+        except (Exception, SystemExit) as e:
+            msg = 'Refresh of "{}" failed: {}'
+            log.error(msg.format(name, e.__class__.__name__))
+        if rate is None:
+            log.warning('Refresh of "{}" failed, retrying soon.'.format(name))
+            self.refresh_at[name] = self.now + RETRY_INTERVAL
+            return
+        moment = roster.now + self.max_interval
+        roster.update_meta(change_rate=rate,
+                           next_refresh=dtfy(moment, as_iso_string=True))
+        self.refresh_at[name] = moment
+
+    def renew(self, name):
+        '''Open a new channel on roster `name`, closing the previous one.'''
+        roster = self.factories[name]()
+        channel_file = ChannelFile(roster.cache_directory, roster.name)
+        old = self.channels.get(name) or channel_file.read()
+        try:
+            service = roster.cal_service_clbk()
+            channel = open_channel(service, roster.cid, self.address,
+                                   self.ttl)
+        except Exception as e:
+            msg = 'Cannot open a channel for "{}": {}'
+            log.error(msg.format(name, e.__class__.__name__))
+            self.renew_at[name] = self.now + RETRY_INTERVAL
+            return
+        log.info('Watching "{}" until {}'.format(name, channel.expiration))
+        self.channels[name] = channel
+        channel_file.write(channel)
+        self.renew_at[name] = channel.expiration - RENEWAL_LEAD
+        if old is not None:
+            self._close(service, name, old)
+
+    def _close(self, service, name, channel):
+        '''Close `channel` (of roster `name`), if Google still knows it.'''
+        try:
+            close_channel(service, channel)
+        except Exception as e:
+            msg = 'Cannot close channel "{}" of "{}": {}'
+            log.warning(msg.format(channel.id, name, e.__class__.__name__))
+
+    def start(self):
+        '''Start the receiver of the notifications, in background.'''
+        self.server = HTTPServer(('', self.port), _Handler)
+        self.server.watcher = self
+        self._thread = threading.Thread(target=self.server.serve_forever,
+                                        name='watch-receiver')
+        self._thread.daemon = True
+        self._thread.start()
+        log.info('Receiving notifications on port {}'.format(self.port))
+
+    def stop(self):
+        '''Close all channels and stop the receiver.'''
+        for name, channel in self.channels.items():
+            roster = self.factories[name]()
+            self._close(roster.cal_service_clbk(), name, channel)
+            ChannelFile(roster.cache_directory, roster.name).remove()
+        self.channels = {}
+        if self.server is not None:
+            self.server.shutdown()
+            self._thread.join()
+            self.server.server_close()
+            self.server = None
+
+    def step(self):
+        '''Serve the notifications, refreshes and renewals due next.'''
+        now = self.now
+        upcoming = min(self.refresh_at.values() + self.renew_at.values())
+        try:
+            names = set([self.pings.get(
+                timeout=max((upcoming - now).total_seconds(), 0))])
+        except Queue.Empty:
+            names = set()
+        if names:
+            time.sleep(DEBOUNCE)  # Changes often come in bursts
+            while not self.pings.empty():
+                names.add(self.pings.get())
+        now = self.now
+        names.update(name for name, moment in self.refresh_at.items()
+                     if moment <= now)
+        for name in sorted(names):
+            self.refresh(name)
+        for name, moment in self.renew_at.items():
+            if moment <= now:
+                self.renew(name)
+
+    def run(self):
+        '''Watch the rosters until interrupted.'''
+        self.start()
+        try:
+            for name in self.factories:
+                self.renew(name)
+                self.refresh(name)
+            while True:
+                self.step()
+        finally:
+            self.stop()
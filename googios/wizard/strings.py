@@ -57,6 +57,13 @@ How many *future* days of the roster would you like to keep in the cache?
     'cache.directory':
 '''
 In what directory should your CVS `{}.cache` file be saved?
+''',
+
+    'cache.backend':
+'''
+In what format should the cache be stored?  `tsv` is a plain text file (plus
+one per month of past shifts), `sqlite` an indexed database better suited to
+long histories and to many concurrent readers.
 ''',
 
     'fallback.email':
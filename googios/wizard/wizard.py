@@ -151,6 +151,16 @@ class Wizard(object):
         choice = prompt.query(question, '0', [validator])
         self.config['roster.time_shift'] = int(choice)
 
+    def pick_cache_backend(self):
+        '''Save the cache backend for the roster.'''
+        self.current_step += 1
+        self.display('cache.backend', ())
+        options = ('tsv', 'sqlite')
+        question = 'Select one of the 2 allowed values'
+        validator = partial(self.validate_options, options=options)
+        choice = prompt.query(question, 'tsv', [validator])
+        self.config['cache.backend'] = choice
+
     def pick_log_level(self):
         '''Save the log level for the roster.'''
         self.current_step += 1
@@ -166,12 +176,13 @@ class Wizard(object):
         # Save the configuration
         self.current_step += 1
         self.display('credentials', ())
+        from ..googios import get_roster, with_defaults  # Circular import
         name = self.config['roster.name']
         self.config_fname = '{}.config'.format(name)
+        with_defaults(self.config)
         with open(self.config_fname, 'w') as file_:
             json.dump(self.config, file_, sort_keys=True, indent=4)
         # Generate the credentials
-        from ..googios import get_roster  # Avoid circular import
         get_roster(self.config).update_cache()
 
     def display(self, string_id, msg_args):
@@ -208,6 +219,7 @@ class Wizard(object):
         self.step('cache.past')
         self.step('cache.future')
         self.step('cache.directory', msg_args=[name])
+        self.pick_cache_backend()
         self.step('fallback.email')
         self.step('fallback.phone')
         self.step('log.directory', msg_args=[name])
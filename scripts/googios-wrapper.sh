@@ -19,6 +19,10 @@
 #   <roster> is the file holding the configuration for a given roster
 #   <contact-method> is either email or phone
 #   <message> is the short message to be delivered as alarm
+#
+# If the answer file materialised by GooGios for the roster (see `googios
+# <roster> materialise`) is found in ONCALL_DIR and is still valid, the contact
+# is read from it, without invoking GooGios at all.
 
 
 # =============================================================================
@@ -31,6 +35,8 @@ declare -A FALLBACKS=(
 declare -A COMMANDS=(
     ["email"]='mailx -s "$MESSAGE" $CONTACT < /dev/null'
     ["phone"]='mailx -s "$MESSAGE" $CONTACT@my.sms.gateway.com < /dev/null')
+# The "cache.directory" of your rosters (leave empty to always invoke GooGios)
+ONCALL_DIR=""
 
 # =============================================================================
 
@@ -46,10 +52,22 @@ METHOD=$2
 MESSAGE=$3
 
 # retrieve contact information for on-call person
-CONTACT=`googios $ROSTER current $METHOD`
-if [ ! $? == 0 ]
+ONCALL_FILE="$ONCALL_DIR/$(basename $ROSTER .config).oncall"
+if [[ $ONCALL_DIR && -r $ONCALL_FILE ]] && source "$ONCALL_FILE" &&
+    (( $(date +%s) < ONCALL_VALID_UNTIL ))
 then
-    CONTACT="${FALLBACKS[$METHOD]}"
+    if [[ $METHOD == 'email' ]]
+    then
+        CONTACT="$ONCALL_EMAIL"
+    else
+        CONTACT="$ONCALL_PHONE"
+    fi
+else
+    CONTACT=`googios $ROSTER current $METHOD`
+    if [ ! $? == 0 ]
+    then
+        CONTACT="${FALLBACKS[$METHOD]}"
+    fi
 fi
 
 # alarm propagation
@@ -69,6 +69,8 @@ setup(
 
     extras_require={
         'dev': ['wheel>=0.24.0'],
+        'intervals': ['numpy>=1.9'],
+        'analytics': ['numpy>=1.9'],
     },
 
     # package_data={
@@ -84,6 +86,7 @@ setup(
     entry_points={
         'console_scripts': [
             'googios=googios.googios:main',
+            'googios-stress=googios.stress:main',
         ],
     },
 )